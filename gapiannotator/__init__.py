@@ -21,6 +21,7 @@ PKG_ROOT = os.path.dirname(os.path.abspath(__file__))
 def webgui():
     from .annotator import ImageLibrary
     signal.signal(signal.SIGINT, goodbye)
+    signal.signal(signal.SIGTERM, goodbye)
     parser = argparse.ArgumentParser(
         description="Automatic image annotator using Google APIs (Cloud Vision, "
                     "Cloud Translation, and Geocoding) with an integrated face tagger. " 
@@ -38,6 +39,11 @@ def webgui():
         default=8000,
         help="Specify the port on which the web server listens. Defaults to 8000",
     )
+    parser.add_argument(
+        "--dev",
+        action='store_true',
+        help="If set, static web assets will be reloaded when their files change.",
+    )
     parser.add_argument(
         'path', 
         nargs='?',
@@ -47,12 +53,13 @@ def webgui():
              " as a translation cache). Defaults to ./annotator.db")
     args = parser.parse_args()
     library = ImageLibrary(args.path)
-    library.launch_webinterface(args.listen,args.port,blocking = True)
+    library.launch_webinterface(args.listen,args.port,blocking = True,dev = args.dev)
     
 def cli():
     from .annotator import ImageLibrary
     from .gapi import Gapi
     signal.signal(signal.SIGINT, goodbye)
+    signal.signal(signal.SIGTERM, goodbye)
     parser = argparse.ArgumentParser(
         description="Automatic image annotator using Google APIs (Cloud Vision, "
                     "Cloud Translation, and Geocoding). This is the command-line interface, "
@@ -180,5 +187,7 @@ def parse_visionfeatures(features):
     return feature_dict
     
 def goodbye(signal=None,frame=None):
+    # also the SIGINT/SIGTERM handler, so it only unwinds the main thread (which releases its locks),
+    # the shutdown handlers run afterwards at interpreter exit (see helper.shutdown_handler)
     print('\nGoodbye...')
     sys.exit(0)
\ No newline at end of file
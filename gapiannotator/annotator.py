@@ -7,13 +7,15 @@
 #
 import os
 import pathlib
-import subprocess
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import re
 import io
+import sqlite3
+import shutil
 import threading
-import queue as Queue
+import heapq
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
 import dateutil.parser
 
@@ -25,8 +27,12 @@ import numpy as np
 
 from . import ROOT
 from .gui import WebGUIServer
-from .helper import sqlitedb, dms_to_decimal, Settings, EventHandler, size_fmt
+from .helper import sqlitedb, Settings, EventHandler, size_fmt
 from .gapi import Gapi
+from .thumbstore import FolderThumbnailStore, PackedThumbnailStore
+from .exifheader import read_header, EMPTY_HEADER
+from .synoindex import SynoIndexer
+from .jobqueue import JobQueue, ProcessingProfile
 
 
 class ImageLibrary:
@@ -47,14 +53,63 @@ class ImageLibrary:
         "always_hide_menu" : False,
         "translate": 'en',
         "is_synology" : False,
+        "synoindex_path" : SynoIndexer.COMMAND,
+        "thumbnail_cache_size" : 64,
+        "thumbnail_store" : 'folder',
+        "metadata_mode" : 'embedded',
+        "embed_time" : '',
         "paths" : []
     }
+    # schema migrations are applied in order, the schema version is stored as sqlite user_version
+    SCHEMA_MIGRATIONS = [
+        # 1: partial covering indexes for keyset pagination of the face listing
+        ["CREATE INDEX IF NOT EXISTS files_untagged_faces ON files(modifedTimesamp, id, filePath) WHERE hasUntaggedFaces=1;",
+         "CREATE INDEX IF NOT EXISTS files_ignored_faces ON files(modifedTimesamp, id, filePath) WHERE hasIgnoredFaces=1;",
+         "CREATE INDEX IF NOT EXISTS files_faces ON files(modifedTimesamp, id, filePath) WHERE hasFaces=1;"],
+        # 2: face regions mirrored from the XMP metadata, so face listings do not have to read any files
+        ["""CREATE TABLE IF NOT EXISTS faces(
+            imageId INTEGER NOT NULL,
+            faceIndex INTEGER NOT NULL,
+            x REAL,
+            y REAL,
+            width REAL,
+            height REAL,
+            name TEXT NOT NULL DEFAULT '',
+            ignored INT2 DEFAULT 0,
+            thumbnail TEXT,
+            PRIMARY KEY(imageId,faceIndex));""",
+         "CREATE INDEX IF NOT EXISTS faces_name ON faces(name);",
+         "ALTER TABLE files ADD facesIndexed INT2 DEFAULT 0;"],
+        # 3: images which are mirrored into the full text search table
+        ["ALTER TABLE files ADD searchIndexed INT2 DEFAULT 0;"],
+        # 4: exif header values, valid as long as the modification time of the file equals headerMtime
+        ["ALTER TABLE files ADD orientation INTEGER;",
+         "ALTER TABLE files ADD latitude REAL;",
+         "ALTER TABLE files ADD longitude REAL;",
+         "ALTER TABLE files ADD width INTEGER;",
+         "ALTER TABLE files ADD height INTEGER;",
+         "ALTER TABLE files ADD headerMtime REAL;"],
+        # 5: images with xmp sidecars which are not embedded yet
+        ["ALTER TABLE files ADD hasSidecar INT2 DEFAULT 0;",
+         "CREATE INDEX IF NOT EXISTS files_sidecar ON files(id) WHERE hasSidecar=1;"],
+        # 6: the face listing reads facesIndexed instead of filePath, the indexes of 1 cover it again
+        #    (sqlite < 3.42 only uses a partial index as covering index if it contains the columns of its WHERE clause)
+        ["DROP INDEX IF EXISTS files_untagged_faces;",
+         "DROP INDEX IF EXISTS files_ignored_faces;",
+         "DROP INDEX IF EXISTS files_faces;",
+         "CREATE INDEX IF NOT EXISTS files_untagged_faces ON files(modifedTimesamp, id, facesIndexed, hasUntaggedFaces) WHERE hasUntaggedFaces=1;",
+         "CREATE INDEX IF NOT EXISTS files_ignored_faces ON files(modifedTimesamp, id, facesIndexed, hasIgnoredFaces) WHERE hasIgnoredFaces=1;",
+         "CREATE INDEX IF NOT EXISTS files_faces ON files(modifedTimesamp, id, facesIndexed, hasFaces) WHERE hasFaces=1;"],
+    ]
+    CLEAN_WORKERS = 8
+    SEARCH_COLUMNS = ['labels','locations','faces']
+    SEARCH_OPERATORS = ['AND','OR','NOT']
     def __init__(self, db_file: str = os.path.join(ROOT,'annotator.db')):
         self.db_file = os.path.abspath(db_file)
         self.db = sqlitedb(self.db_file)
         self.log_queue = []
         self.gapi = None
-        self.processingqueue = Queue.Queue()
+        self.processingqueue = JobQueue()
         self.event = EventHandler()
         self.checkTable()
         self.settings = Settings(self.db, self.DEFAULT_SETTINGS)
@@ -89,12 +144,24 @@ class ImageLibrary:
             hash TEXT NOT NULL DEFAULT 0,
             addedTimesamp INTEGER DEFAULT (strftime('%s', 'now')),
             modifedTimesamp INTEGER DEFAULT (strftime('%s', 'now')),
-            originalTimestamp INTEGER);""",True)
+            originalTimestamp INTEGER);""",commit=True)
         self.db.execute("""CREATE TABLE IF NOT EXISTS similarity(
             id1 INTEGER NOT NULL,
             id2 INTEGER NOT NULL, 
             dist INTEGER,
-            PRIMARY KEY(id1,id2));""",True)
+            PRIMARY KEY(id1,id2));""",commit=True)
+        
+        (version,) = self.db.execute("PRAGMA user_version;").fetchone()
+        for (version,migration) in enumerate(self.SCHEMA_MIGRATIONS[version:],version+1):
+            [self.db.execute(sql) for sql in migration]
+            self.db.execute(f"PRAGMA user_version = {int(version)};",commit=True)
+        
+        if self.db.fts5:
+            # rowid is the image id, the prefix indexes speed up prefix queries
+            self.db.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+                {', '.join(self.SEARCH_COLUMNS)},
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3');""",commit=True)
     
     def on_settings_changed(self,changed_settings):
         if any([key in changed_settings for key in ['scan_new','blacklist','paths','whitelist']]):
@@ -109,6 +176,34 @@ class ImageLibrary:
         if 'hash_size' in changed_settings:
             self.rehash(self.settings['hash_size'])
             
+        if 'synoindex_path' in changed_settings and hasattr(self,'_synoindexer'):
+            self._synoindexer.command = self.settings.synoindex_path
+            
+        if 'embed_time' in changed_settings:
+            self.schedule_embed()
+            
+        if any([key in changed_settings for key in ['thumbnail_store','is_synology']]) and hasattr(self,'_thumbnail_store'):
+            self._thumbnail_store.close()
+            delattr(self,'_thumbnail_store')
+    
+    @property
+    def thumbnails(self):
+        if not hasattr(self,'_thumbnail_store'):
+            # synology photo station requires the '@eaDir' layout
+            if self.settings.is_synology:
+                self._thumbnail_store = FolderThumbnailStore('@eaDir')
+            elif self.settings.thumbnail_store == 'packed':
+                self._thumbnail_store = PackedThumbnailStore(self.db, os.path.join(os.path.dirname(self.db_file),'thumbnails'))
+            else:
+                self._thumbnail_store = FolderThumbnailStore('.thumbs')
+        return self._thumbnail_store
+            
+    @property
+    def synoindexer(self):
+        if not hasattr(self,'_synoindexer'):
+            self._synoindexer = SynoIndexer(self.settings.synoindex_path,self.log)
+        return self._synoindexer
+    
     def get_images(self,paths: List[str]):
         files = self.scan_for_files(paths)
         return [self.get_image(file_path) for file_path in files if os.path.exists(file_path)]
@@ -116,6 +211,25 @@ class ImageLibrary:
     def get_image(self,file_path: str):
         return _Image(self,file_path)
     
+    def get_records(self,ids: List[int]=None,paths: List[str]=None,check_exists: bool=True):
+        # read-only records for listings, built in bulk from the files table without touching the metadata
+        if ids is not None:
+            keys = [int(imgindex) for imgindex in ids]
+            column = 'id'
+        else:
+            keys = [os.path.abspath(file_path) for file_path in paths]
+            column = 'filePath'
+        records = []
+        for i in range(0,len(keys),ImageRecord.CHUNK_SIZE):
+            chunk = keys[i:i+ImageRecord.CHUNK_SIZE]
+            rows = self.db.execute(f"""SELECT {', '.join(ImageRecord.COLUMNS)} FROM files 
+                                       WHERE {column} IN ({', '.join('?'*len(chunk))});""",chunk).fetchall()
+            for row in rows:
+                record = ImageRecord(*row)
+                if not check_exists or record.stat():
+                    records.append(record)
+        return records
+    
     def spawn_threads(self, num_threads: int = DEFAULT_SETTINGS['num_threads']):
         if not hasattr(self,'processingthreads'):
             self.processingthreads = []
@@ -173,17 +287,19 @@ class ImageLibrary:
             self.log('No valid GAPI key/credentials, skipping annotation.')
             return
         files = self.scan_for_files(paths,whitelist,blacklist)
+        # files which reappeared (e.g. rewritten by jpegtran) must not be removed
+        if hasattr(self,'_deletions'):
+            [self._deletions.cancel(file_path) for file_path in files]
         if files:
             # populate queue
             self.event('remaining_files',self.files_in_queue+len(files))
-            [self.processingqueue.put({'file_path':file_path,
-                                      'cmd': 'process',
-                                      'vision_features':vision_features,
-                                      'reverse_geocoding':reverse_geocoding,
-                                      'translate':translate,
-                                      'replace_labels':replace_labels,
-                                      'rotate_images':rotate_images,
-                                      'reannotate':reannotate}) for file_path in files]
+            self.processingqueue.put_many(files,ProcessingProfile.get('process',
+                                                                      vision_features=vision_features,
+                                                                      reverse_geocoding=reverse_geocoding,
+                                                                      translate=translate,
+                                                                      replace_labels=replace_labels,
+                                                                      rotate_images=rotate_images,
+                                                                      reannotate=reannotate))
             self.event('remaining_files',self.files_in_queue)
             if blocking:
                 self.log('Processing {} file(s)...'.format(len(files)))
@@ -197,8 +313,8 @@ class ImageLibrary:
             
     def rehash(self,hash_size: int=DEFAULT_SETTINGS['hash_size']):
         res = self.db.execute("SELECT filePath FROM files ORDER BY id ASC;").fetchall()
-        self.db.execute("DELETE FROM similarity;",True) #TODO
-        [self.processingqueue.put({'file_path':file_path, 'cmd': 'rehash', 'hash_size': hash_size}) for (file_path,) in res]
+        self.db.execute("DELETE FROM similarity;",commit=True) #TODO
+        self.processingqueue.put_many([file_path for (file_path,) in res],ProcessingProfile.get('rehash',hash_size=hash_size))
         
                 
     def on_startup(self):
@@ -218,61 +334,200 @@ class ImageLibrary:
             
         if self.settings.scan_new:
             self.watch()
+            
+        self.index_search()
+        self.schedule_embed()
+    
+    def index_search(self):
+        # images which were saved before the search table existed are indexed by the processing threads
+        if self.db.fts5:
+            res = self.db.execute("SELECT filePath FROM files WHERE searchIndexed = 0;").fetchall()
+            if res:
+                self.log(f'Indexing {len(res)} file(s) for search')
+                self.processingqueue.put_many([file_path for (file_path,) in res],ProcessingProfile.get('update_search_index'))
+                self.event('remaining_files',self.files_in_queue)
+    
+    def embed_sidecars(self):
+        # folds the xmp sidecars back into the images
+        res = self.db.execute("SELECT filePath FROM files WHERE hasSidecar = 1;").fetchall()
+        if res:
+            self.log(f'Embedding {len(res)} sidecar(s)')
+            self.processingqueue.put_many([file_path for (file_path,) in res],ProcessingProfile.get('embed_sidecar'))
+            self.event('remaining_files',self.files_in_queue)
+    
+    def schedule_embed(self):
+        # embeds the sidecars once a day at embed_time (e.g. '03:00'), disabled if empty
+        if hasattr(self,'embed_timer'):
+            self.embed_timer.cancel()
+        if not self.settings.embed_time:
+            return
+        try:
+            (hour,minute) = [int(x) for x in self.settings.embed_time.split(':')]
+            now = datetime.now()
+            next_run = now.replace(hour=hour,minute=minute,second=0,microsecond=0)
+        except ValueError:
+            self.log(f'Invalid embed time "{self.settings.embed_time}", expected HH:MM')
+            return
+        if next_run <= now:
+            next_run += timedelta(days=1)
+        def run():
+            self.embed_sidecars()
+            self.schedule_embed()
+        self.embed_timer = threading.Timer((next_run-now).total_seconds(),run)
+        self.embed_timer.daemon = True
+        self.embed_timer.start()
+    
+    @classmethod
+    def build_search_query(cls,query: str):
+        # every term is quoted, so user input can not break the fts5 syntax,
+        # supported are AND/OR/NOT (default AND), "phrases", prefix*, column:term and parentheses
+        match = []
+        for token in re.findall(r'(?:\w+:)?"[^"]*"\*?|[()]|[^\s()"]+',query):
+            if token.upper() in cls.SEARCH_OPERATORS:
+                match.append(token.upper())
+            elif token in '()':
+                match.append(token)
+            else:
+                column = ''
+                (name,sep,term) = token.partition(':')
+                if sep and name in cls.SEARCH_COLUMNS:
+                    (column,token) = (f'{name} : ',term)
+                prefix = '*' if token.endswith('*') else ''
+                token = token.rstrip('*').strip('"').replace('"','""')
+                if token:
+                    match.append(f'{column}"{token}"{prefix}')
+        return ' '.join(match)
+    
+    def search(self,query: str,limit: int=50,lastimageid: int=None):
+        # returns image ids, newest first, the next page starts below the last image id of the previous page
+        match = self.build_search_query(query)
+        if not self.db.fts5 or not match:
+            return []
+        try:
+            if lastimageid is None:
+                res = self.db.execute("SELECT rowid FROM search WHERE search MATCH ? ORDER BY rowid DESC LIMIT ?;",(match,int(limit)))
+            else:
+                res = self.db.execute("SELECT rowid FROM search WHERE search MATCH ? AND rowid < ? ORDER BY rowid DESC LIMIT ?;",(match,int(lastimageid),int(limit)))
+            return [imgindex for (imgindex,) in res.fetchall()]
+        except sqlite3.OperationalError as e:
+            self.log(f'Invalid search query "{query}": {e}')
+            return []
     
     def launch_webinterface(self,
                             addr: str='0.0.0.0',
                             port: int=8000,
-                            blocking: bool=False):
+                            blocking: bool=False,
+                            dev: bool=False):
         if not hasattr(self,'webserver'):
-            self.webserver = WebGUIServer(self,addr=addr,port=port)
+            self.webserver = WebGUIServer(self,addr=addr,port=port,dev=dev)
             self.webserver.start()
             self.on_startup()
             if blocking:
                 self.webserver.join()
                 
     def move(self,from_path: str,to_path: str):
-        esc_from_path = from_path.replace("'", "''")
-        esc_to_path = to_path.replace("'", "''")
         is_dir = os.path.isdir(to_path)
         is_file = os.path.isfile(to_path)
         if is_dir:
-            self.db.execute(f"UPDATE files SET filePath = REPLACE(filePath,'{esc_from_path}','{esc_to_path}');",True)
+            # all paths below the folder form a range of the filePath index: [from/, from0)
+            prefix = os.path.join(from_path,'')
+            prefix_upper = prefix[:-1]+chr(ord(prefix[-1])+1)
+            self.db.execute("UPDATE files SET filePath = ? || substr(filePath,?) WHERE filePath >= ? AND filePath < ?;",
+                            (os.path.join(to_path,''),len(prefix)+1,prefix,prefix_upper),commit=True)
             self.log(f'Moved folder from {from_path} to {to_path}')
         elif is_file:
             filter = self.build_filter(self.settings.whitelist,self.settings.blacklist)
             if filter(from_path,None,False) and filter(to_path,None,False):
-                self.db.execute(f"UPDATE files SET filePath = REPLACE(filePath,'{esc_from_path}','{esc_to_path}') WHERE filePath = '{esc_from_path}';",True)
+                row = self.db.execute("SELECT id FROM files WHERE filePath = ?;",(from_path,)).fetchone()
+                self.db.execute("UPDATE files SET filePath = ? WHERE filePath = ?;",(to_path,from_path),commit=True)
+                # thumbnails stored next to the image have to follow it
+                if row:
+                    self.thumbnails.move(row[0],from_path,to_path)
+                # sidecars of moved images are moved along
+                if os.path.exists(from_path+_Image.SIDECAR_EXTENSION) and not os.path.exists(to_path+_Image.SIDECAR_EXTENSION):
+                    os.rename(from_path+_Image.SIDECAR_EXTENSION,to_path+_Image.SIDECAR_EXTENSION)
                 #TODO send websocket info
                 self.log(f'Moved file from {from_path} to {to_path}')
                 
     def delete(self,path: str,withdelay: bool=True):
-        def remove_from_db():
-            if not os.path.exists(path):
-                if self.settings.is_synology:
-                    subprocess.run(['/usr/syno/bin/synoindex', '-d', path],capture_output=True)
-
-                esc_path = path.replace("'", "''")
-                try:
-                    (imgindex,)=self.db.execute(f"SELECT id FROM files WHERE filePath = '{esc_path}';").fetchone()
-                    self.event('deleted_image',imgindex)
-                    self.log(f'Removed file {path}') 
-                    self.db.execute(f"DELETE FROM files WHERE id = {imgindex};",True)
-                    self.db.execute(f"DELETE FROM similarity WHERE id1 = {imgindex} OR id2 = {imgindex};",True) 
-                except:
-                    pass
-                
         filter = self.build_filter(self.settings.whitelist,self.settings.blacklist)
         if filter(path,None,False):
             # we delete with an delay of 10 seconds because jpegtran does not modify, but delete and write a new file
             if withdelay:
-                threading.Timer(10,remove_from_db).start()
+                self.deletions.schedule(path)
             else:
-                remove_from_db()
+                self.remove_files([path])
+    
+    @property
+    def deletions(self):
+        if not hasattr(self,'_deletions'):
+            self._deletions = DeletionThread(self)
+            self._deletions.start()
+        return self._deletions
+    
+    def remove_files(self,paths: List[str]):
+        # removes all files which do not exist (anymore) from the library with set-based deletes
+        paths = [path for path in paths if not os.path.exists(path)]
+        if self.settings.is_synology:
+            [self.synoindexer.delete(path) for path in paths]
+        removed = []
+        for i in range(0,len(paths),ImageRecord.CHUNK_SIZE):
+            chunk = paths[i:i+ImageRecord.CHUNK_SIZE]
+            removed.extend(self.db.execute(f"SELECT id, filePath FROM files WHERE filePath IN ({', '.join('?'*len(chunk))});",chunk).fetchall())
+        self.remove_entries(removed)
+        if len(removed) == 1:
+            self.log(f'Removed file {removed[0][1]}')
+        elif removed:
+            self.log(f'Removed {len(removed)} files')
+        return len(removed)
     
-    def clean(self):
-        deleted_files = tuple([file_id for (file_id, file_path) in self.db.execute("SELECT id,filePath FROM files;").fetchall() if not os.path.exists(file_path)])
-        self.db.execute(f"DELETE FROM files WHERE id IN {deleted_files};",True)
-        self.log(f'Cleared {len(deleted_files)} file(s)')
+    def remove_entries(self,removed: List[tuple]):
+        # removes the given (id, filePath) entries including similarities, faces, search entries and thumbnails
+        for (imgindex, path) in removed:
+            self.event('deleted_image',imgindex)
+            self.thumbnails.remove_all(imgindex,path)
+        # the similarity delete binds every id twice, old sqlite versions allow at most 999 variables
+        chunk_size = ImageRecord.CHUNK_SIZE//2
+        for i in range(0,len(removed),chunk_size):
+            ids = [imgindex for (imgindex, path) in removed[i:i+chunk_size]]
+            placeholders = ', '.join('?'*len(ids))
+            self.db.execute(f"DELETE FROM files WHERE id IN ({placeholders});",ids)
+            self.db.execute(f"DELETE FROM similarity WHERE id1 IN ({placeholders}) OR id2 IN ({placeholders});",ids+ids)
+            self.db.execute(f"DELETE FROM faces WHERE imageId IN ({placeholders});",ids)
+            if self.db.fts5:
+                self.db.execute(f"DELETE FROM search WHERE rowid IN ({placeholders});",ids)
+        self.db.commit()
+    
+    def clean(self,workers: int=CLEAN_WORKERS):
+        # files are grouped by folder, every folder is listed once (in parallel) instead of a stat per file
+        folders = {}
+        for (file_id, file_path) in self.db.execute("SELECT id, filePath FROM files;"):
+            (folder, name) = os.path.split(file_path)
+            folders.setdefault(folder,[]).append((file_id, file_path, name))
+        def list_folder(folder):
+            try:
+                with os.scandir(folder) as entries:
+                    return set([entry.name for entry in entries])
+            except (FileNotFoundError, NotADirectoryError):
+                return set()
+            except OSError as e:
+                # unreadable folders are kept, the files might still exist
+                self.log(f'Skipped folder {folder} while cleaning: {e}')
+                return None
+        (removed, batch) = (0, [])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for (done, (folder, names)) in enumerate(zip(folders,executor.map(list_folder,folders)),1):
+                if names is not None:
+                    batch.extend([(file_id, file_path) for (file_id, file_path, name) in folders[folder] if not name in names])
+                if len(batch) >= ImageRecord.CHUNK_SIZE or done == len(folders):
+                    self.remove_entries(batch)
+                    removed += len(batch)
+                    batch = []
+                self.event('clean_progress',{'done': done, 'total': len(folders), 'removed': removed})
+        self.log(f'Cleared {removed} file(s)')
+        freed = self.thumbnails.compact()
+        if freed:
+            self.log(f'Compacted thumbnail store, freed {size_fmt(freed)}')
         
     def unwatch(self):
         if hasattr(self,'watch_thread'):
@@ -287,6 +542,40 @@ class ImageLibrary:
     def files_in_queue(self):
         return self.processingqueue.qsize()
 
+class ImageRecord:
+    __slots__ = ('index','file_path','date','is_annotated','has_faces','has_untagged_faces','has_ignored_faces','size')
+    COLUMNS = ('id','filePath','originalTimestamp','isAnnotated','hasFaces','hasUntaggedFaces','hasIgnoredFaces')
+    CHUNK_SIZE = 500
+    
+    def __init__(self,index,file_path,date,is_annotated,has_faces,has_untagged_faces,has_ignored_faces):
+        self.index = index
+        self.file_path = file_path
+        self.date = date
+        self.is_annotated = bool(is_annotated)
+        self.has_faces = bool(has_faces)
+        self.has_untagged_faces = bool(has_untagged_faces)
+        self.has_ignored_faces = bool(has_ignored_faces)
+        self.size = 0
+        
+    def stat(self):
+        # reads size (and the modification date, if the original date is unknown), returns False if the file does not exist
+        try:
+            stat = os.stat(self.file_path)
+        except OSError:
+            return False
+        self.size = stat.st_size
+        if not self.date:
+            self.date = stat.st_mtime
+        return True
+    
+    @property
+    def file_name(self):
+        return os.path.basename(self.file_path)
+    
+    def to_image(self,library):
+        # full image object, required for any modification
+        return _Image(library,self.file_path)
+        
 class WatchFolderThread(threading.Thread):
     def __init__(self,library):
         threading.Thread.__init__(self)
@@ -372,10 +661,52 @@ class WatchFolderThread(threading.Thread):
                 break;
         self.library.log("Stop watching.")
         
+class DeletionThread(threading.Thread):
+    # deleted files are removed after a delay by a single thread, all expired paths are removed together
+    DELAY = 10
+    
+    def __init__(self,library,delay: float=DELAY):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        
+        self.library = library
+        self.delay = delay
+        self.heap = [] # (due, path), cancelled or rescheduled entries are skipped
+        self.due = {}
+        self.condition = threading.Condition()
+        
+    def schedule(self,path: str):
+        with self.condition:
+            due = time.monotonic()+self.delay
+            self.due[path] = due
+            heapq.heappush(self.heap,(due,path))
+            self.condition.notify()
+            
+    def cancel(self,path: str):
+        with self.condition:
+            self.due.pop(path,None)
+            
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.heap or self.heap[0][0] > time.monotonic():
+                    self.condition.wait(self.heap[0][0]-time.monotonic() if self.heap else None)
+                expired = []
+                while self.heap and self.heap[0][0] <= time.monotonic():
+                    (due, path) = heapq.heappop(self.heap)
+                    if self.due.get(path) == due:
+                        del self.due[path]
+                        expired.append(path)
+            if expired:
+                try:
+                    self.library.remove_files(expired)
+                except Exception as e:
+                    self.library.log(f'Error while removing {len(expired)} file(s)\nError message: {e}')
+        
 class ProcessingThread(threading.Thread):
     def __init__(self,
                  library: ImageLibrary,
-                 queue: Queue.Queue):
+                 queue: JobQueue):
         threading.Thread.__init__(self)
         self.daemon = True
         
@@ -389,15 +720,13 @@ class ProcessingThread(threading.Thread):
 
     def run(self):
         while True:
-            args=self.queue.get()
+            (file_path, profile) = self.queue.get()
             try:
-                file_path = args.pop('file_path')
-                cmd = args.pop('cmd')
                 image = _Image(self.library,file_path)
-                getattr(image,cmd)(**args)
+                getattr(image,profile.cmd)(**profile.kwargs)
                 image.save()
             except Exception as e:
-                self.library.log(f'Error while calling "{cmd}" on file {file_path}\nError message: {e}')
+                self.library.log(f'Error while calling "{profile.cmd}" on file {file_path}\nError message: {e}')
             self.library.event('remaining_files',self.queue.qsize())
             self.queue.task_done()
             if (self._terminate):
@@ -410,6 +739,9 @@ class _Image:
                   'L': {'size':(800,800),'file_name':'SYNOPHOTO_THUMB_L.jpg','quality':90,'crop':False},
                   'XL':{'size':(1280,1280),'file_name':'SYNOPHOTO_THUMB_XL.jpg','quality':90,'crop':False},
                   'P': {'size':(120,160),'file_name':'SYNOPHOTO_THUMB_PREVIEW.jpg','quality':90,'crop':True}}
+    SIDECAR_EXTENSION = '.xmp'
+    DB_COLUMNS = ['isAnnotated','hash','originalTimestamp','orientation','latitude','longitude','width','height','headerMtime']
+    LOCATION_TAGS = ['Xmp.iptc.Location','Xmp.photoshop.City','Xmp.photoshop.State','Xmp.photoshop.Country']
 
     def __init__(self,
                  library: ImageLibrary,
@@ -446,10 +778,9 @@ class _Image:
     
     def rehash(self,hash_size: int=ImageLibrary.DEFAULT_SETTINGS['hash_size']):
         if not hasattr(self,'_hash'):
-            (self._hash, ) = self.library.db.execute(f"SELECT hash FROM files WHERE id = {self.index};").fetchone()
+            self._hash = self._db_row['hash']
         if not self._hash or not (len(self._hash) == int(np.ceil((hash_size**2)/4))):
-            #image = PIL.Image.open(io.BytesIO(self.get_thumbnail('S').as_blob()))
-            image = PIL.Image.open(self.create_thumbnail('S'))
+            image = PIL.Image.open(io.BytesIO(self.get_thumbnail('S').as_blob()))
             image = image.convert("L").resize((hash_size + 1, hash_size), PIL.Image.ANTIALIAS)
             pixels = np.asarray(image)
             # compute dhash
@@ -461,13 +792,14 @@ class _Image:
             maxdist = int(round(width*4*0.1))
             # calculate distances between all images in SQL (fast)
             if self.library.db.hexhammdist:
-                self.library.db.execute(f"INSERT INTO similarity (id1, id2, dist) SELECT id, {self.index} AS id2, hexhammdist(hash, '{self._hash}') as hd FROM files WHERE id < {self.index} AND length(hash)={width} AND hd <= {maxdist};", True)
+                self.library.db.execute_deferred("INSERT INTO similarity (id1, id2, dist) SELECT id, ? AS id2, hexhammdist(hash, ?) as hd FROM files WHERE id < ? AND length(hash)=? AND hd <= ?;",
+                                                 (self.index,self._hash,self.index,width,maxdist))
                 #values = self.library.db.execute(f"SELECT a.id, b.id, hexhammdist(a.hash, b.hash) FROM files a INNER JOIN files b ON b.id = {self.index} AND a.id < b.id AND length(a.hash)=length(b.hash);").fetchall()
                 #values = ", ".join([f'({id1}, {id2}, {dist})' for (id1,id2,dist) in values])
                 #self.library.db.execute(f"INSERT INTO similarity (id1, id2, dist) VALUES {values}",True)
             # calculate distances between all images in python (slow)
             else:
-                res = self.library.db.execute(f"SELECT id, hash FROM files FROM files WHERE id < {self.index} AND length(hash)={width};").fetchall()
+                res = self.library.db.execute("SELECT id, hash FROM files WHERE id < ? AND length(hash)=?;",(self.index,width)).fetchall()
                 values = []
                 for (idx,hash1) in res:
                     hash1 = [int(x) for x in bin(int(hash1, 16))[2:].zfill(len(hash1)*4)]
@@ -477,8 +809,7 @@ class _Image:
                         values.append((idx,self.index,dist))
             
                 if values:
-                    values = ", ".join([f'({id1}, {id2}, {dist})' for (id1,id2,dist) in values])
-                    self.library.db.execute(f"INSERT INTO similarity (id1, id2, dist) VALUES {values}",True)
+                    self.library.db.execute_deferred("INSERT INTO similarity (id1, id2, dist) VALUES (?,?,?);",values,many=True)
     
     def __hash__(self):
         return self.hash
@@ -504,38 +835,45 @@ class _Image:
     @property
     def date(self):
         if not hasattr(self,'_date'):
-            (self._date, ) = self.library.db.execute(f"SELECT originalTimestamp FROM files WHERE id = {self.index};").fetchone()
-            if (not self._date): # or not 'Exif.Photo.DateTimeOriginal' in self.metadata): #TODO
+            self._date = self._db_row['originalTimestamp']
+            if (not self._date):
+                # use exif tag
+                self._date = self.header['date']
+            if (not self._date):
                 try:
-                    # use exif tag
-                    self._date = self.metadata['Exif.Photo.DateTimeOriginal'].value.timestamp()
+                    # search filename
+                    # remove possible numbers at the end of the file name (causes problems for dateutil parser)
+                    timestring = re.sub(r"[^\d]\d{1,5}\..{3,4}$",'',self.file_name)
+                    self._date = dateutil.parser.parse(timestring,fuzzy=True).timestamp()
                 except:
-                    try:
-                        # search filename
-                        # remove possible numbers at the end of the file name (causes problems for dateutil parser)
-                        timestring = re.sub(r"[^\d]\d{1,5}\..{3,4}$",'',self.file_name)
-                        self._date = dateutil.parser.parse(timestring,fuzzy=True).timestamp()
-                    except:
-                        # use file modification date
-                        self._date = self.file.stat().st_mtime
+                    # use file modification date
+                    self._date = self.file.stat().st_mtime
         return self._date
     
     @property
     def index(self):
         if not hasattr(self,'_index'):
-            esc_file_path = self.file_path.replace("'", "''")
-            try:
-                (self._index, ) = self.library.db.execute(f"SELECT id FROM files WHERE filePath = '{esc_file_path}';").fetchone()
-            except TypeError:
+            row = self.library.db.execute(f"SELECT id, {', '.join(self.DB_COLUMNS)} FROM files WHERE filePath = ?;",(self.file_path,)).fetchone()
+            if row:
+                self._index = row[0]
+                self._db_row = dict(zip(self.DB_COLUMNS,row[1:]))
+            else:
+                # the new row will be committed with the next group commit, therefore all further 
+                # columns are cached, since they can not be read back until then
+                cursor = self.library.db.execute_deferred("INSERT OR IGNORE INTO files (filePath) VALUES (?);",(self.file_path,))
+                if cursor.rowcount == 0:
+                    # inserted by another thread but not committed yet
+                    self.library.db.flush()
+                    return self.index
                 self.is_new_file = True
-                self.library.db.execute(f"INSERT INTO files (filePath) VALUES ('{esc_file_path}');",True)
-                return self.index
+                self._index = cursor.lastrowid
+                self._db_row = dict({column: None for column in self.DB_COLUMNS},isAnnotated=0,hash='')
         return int(self._index)
     
     @property
     def is_annotated(self):
         if not hasattr(self, '_is_annotated'):
-            (self._is_annotated, ) = self.library.db.execute(f"SELECT isAnnotated FROM files WHERE id = {self.index};").fetchone()
+            self._is_annotated = self._db_row['isAnnotated']
         return bool(int(self._is_annotated))
     
     @is_annotated.setter
@@ -549,35 +887,64 @@ class _Image:
         hasUntaggedFaces = int(bool(self.untagged_faces))
         hasIgnoredFaces = int(bool(self.ignored_faces))
         
-        modifedTimesamp = ""
-        if updateTimestamp:
-            timestamp = int(time.time())
-            modifedTimesamp = f", modifedTimesamp = {timestamp}"
-        
-        self.library.db.execute(f"""UPDATE files
-                            SET isAnnotated = {isAnnotated},
-                                hasFaces = {hasFaces},
-                                hasUntaggedFaces = {hasUntaggedFaces},
-                                hasIgnoredFaces = {hasIgnoredFaces},
-                                hash = '{self.hash}',
-                                originalTimestamp = {self.date}
-                                {modifedTimesamp}
+        modifedTimesamp = int(time.time()) if updateTimestamp else None
+        
+        params = (isAnnotated,hasFaces,hasUntaggedFaces,hasIgnoredFaces,self.hash,self.date,modifedTimesamp,
+                  self.header['orientation'],*(self.header['latlon'] or (None,None)),self.header['width'],self.header['height'],
+                  self._header_mtime,int(os.path.exists(self.sidecar_path)),self.index)
+        with self.library.db.group():
+            self.library.db.execute_deferred("""UPDATE files
+                            SET isAnnotated = ?,
+                                hasFaces = ?,
+                                hasUntaggedFaces = ?,
+                                hasIgnoredFaces = ?,
+                                hash = ?,
+                                originalTimestamp = ?,
+                                modifedTimesamp = COALESCE(?,modifedTimesamp),
+                                orientation = ?,
+                                latitude = ?,
+                                longitude = ?,
+                                width = ?,
+                                height = ?,
+                                headerMtime = ?,
+                                hasSidecar = ?
                             WHERE
-                                id = {self.index};""",True)
+                                id = ?;""",params)
+            self.update_faces_table()
+            self.update_search_index()
+        
+    def update_faces_table(self):
+        values = [(self.index, face.index, *(face.rect or (0,0,0,0)), face.name or '', int(face.ignored), face.thumbnail_name) for face in self.faces]
+        with self.library.db.group():
+            self.library.db.execute_deferred("DELETE FROM faces WHERE imageId = ?;",(self.index,))
+            if values:
+                self.library.db.execute_deferred("INSERT INTO faces (imageId, faceIndex, x, y, width, height, name, ignored, thumbnail) VALUES (?,?,?,?,?,?,?,?,?);",values,many=True)
+            self.library.db.execute_deferred("UPDATE files SET facesIndexed = 1 WHERE id = ?;",(self.index,))
             
-    @property 
-    def thumb_path(self):
-        if self.library.settings.is_synology:
-            return os.path.join(self.path,'@eaDir',self.file_name)
-        else:
-            return os.path.join(self.path,'.thumbs',self.file_name)
+    def update_search_index(self):
+        if not self.library.db.fts5:
+            return
+        entry = (', '.join(self.labels), ', '.join(self.locations), ', '.join([face.name for face in self.named_faces]))
+        # the processing threads save every image, so the same entry is not written twice
+        if getattr(self,'_search_entry',None) != entry:
+            with self.library.db.group():
+                self.library.db.execute_deferred("DELETE FROM search WHERE rowid = ?;",(self.index,))
+                self.library.db.execute_deferred("INSERT INTO search (rowid, labels, locations, faces) VALUES (?,?,?,?);",(self.index,*entry))
+                self.library.db.execute_deferred("UPDATE files SET searchIndexed = 1 WHERE id = ?;",(self.index,))
+            self._search_entry = entry
+            
+    @property
+    def thumbnails(self):
+        return self.library.thumbnails
         
     def remove_exif_orientation(self):
         if self.orientation != 1:
-            jpegtran.JPEGImage(self.file_path).exif_autotransform().save(self.file_path)
-            
-            # force reread of metadata
-            delattr(self,'_metadata')
+            # the transformed image is only kept in memory, save() writes it together with the metadata in a single pass
+            self._transformed = jpegtran.JPEGImage(self.file_path).exif_autotransform()
+            self._metadata = self._Metadata(self.file_path,self.sidecar_path,self.library.settings.metadata_mode == 'sidecar',
+                                            buffer=self._transformed.as_blob())
+            self._header = dict(self.header,orientation=1,width=self._transformed.width,height=self._transformed.height)
+            self.changed = True
         
     def get_downscale_size(self,x:int,y:int,new_x:int,new_y:int,use_max:bool=True):
         if use_max:
@@ -590,60 +957,126 @@ class _Image:
             return (x,y)
         
     def create_all_thumbnails(self):
-        for size in self.THUMBNAILS.keys():
-            self.create_thumbnail(size)
+        self.create_thumbnail_pyramid()
+    
+    def source_image(self):
+        # decoded image with the orientation applied, a pending rotation is reused from memory
+        if hasattr(self,'_transformed'):
+            return self._transformed
+        img = jpegtran.JPEGImage(self.file_path)
+        if self.orientation != 1:
+            img = img.exif_autotransform()
+        return img
+    
+    def _downscale_thumbnail(self,img,size: str,orig_size: tuple):
+        # downscale img (which has the orientation applied) to the thumbnail size, 
+        # target dimensions are computed from the original size to avoid accumulated rounding errors
+        prop = self.THUMBNAILS[size]
+        if not prop['crop']:
+            return img.downscale(*self.get_downscale_size(*orig_size,*prop['size']),prop['quality'])
+        (x,y) = prop['size']
+        img = img.downscale(*self.get_downscale_size(*orig_size,x,y,False),prop['quality'])
+        (offset_x,offset_y) = (int(round((img.width-x)/2)),int(round((img.height-y)/2)))
+        # jpeg lossless cropping requires (at worst) a multiple of 16x16 pixels
+        (offset_x,offset_y) = (offset_x-(offset_x % 16),offset_y-(offset_y % 16))
+        return img.crop(offset_x,offset_y,x,y)
+    
+    def create_thumbnail_pyramid(self,sizes: List[str]=None):
+        sizes = [size for size in (sizes or self.THUMBNAILS.keys()) if size in self.THUMBNAILS]
+        missing = [size for size in sizes if not self.thumbnails.exists(self,self.THUMBNAILS[size]['file_name'])]
+        if missing:
+            # decode the original only once and derive all thumbnails by cascading downscales, 
+            # each size is computed from the smallest already computed thumbnail which is large enough
+            img = self.source_image()
+            orig_size = (img.width,img.height)
+            
+            def target_size(size):
+                prop = self.THUMBNAILS[size]
+                return self.get_downscale_size(*orig_size,*prop['size'],not prop['crop'])
+            
+            levels = []
+            for size in sorted(sizes, key=lambda size: target_size(size)[0]*target_size(size)[1], reverse=True):
+                (w,h) = target_size(size)
+                source = next((level for level in reversed(levels) if level.width >= w and level.height >= h), img)
+                thumb = self._downscale_thumbnail(source,size,orig_size)
+                self._thumbnails[size] = thumb
+                if not self.THUMBNAILS[size]['crop']:
+                    levels.append(thumb)
+            
+            # write all missing thumbnails together
+            self.thumbnails.write_many(self,{self.THUMBNAILS[size]['file_name']: self._thumbnails[size].as_blob() for size in missing})
     
     def create_thumbnail(self,size: str='L'):
         if not size in self.THUMBNAILS:
             size = 'L'
-        prop = self.THUMBNAILS[size]
-        thumb_file = os.path.abspath(os.path.join(self.thumb_path,prop['file_name']))
+        img = self.source_image()
+        thumb = self._downscale_thumbnail(img,size,(img.width,img.height))
+        self.thumbnails.write(self,self.THUMBNAILS[size]['file_name'],thumb.as_blob())
+        return thumb
         
-        if not os.path.exists(thumb_file):
-            img = jpegtran.JPEGImage(self.file_path)
-            if self.orientation !=1:
-                img=img.exif_autotransform()
-            
-            os.makedirs(self.thumb_path, exist_ok=True)
-        
-            if not prop['crop']:
-                img.downscale(*self.get_downscale_size(img.width,img.height,*prop['size']),prop['quality']
-                              ).save(thumb_file)
+    @property
+    def header(self):
+        # date, orientation, gps position and dimensions without reading the whole metadata,
+        # the values stored in the db are used as long as the file was not modified
+        if not hasattr(self,'_header'):
+            row = self._db_row
+            self._header_mtime = self.file.stat().st_mtime
+            if row['headerMtime'] is not None and row['headerMtime'] == self._header_mtime:
+                self._header = dict(EMPTY_HEADER,
+                                    orientation=row['orientation'] or 1,
+                                    latlon=(row['latitude'],row['longitude']) if row['latitude'] is not None else None,
+                                    width=row['width'],
+                                    height=row['height'])
             else:
-                (x,y) = prop['size']
-                img = img.downscale(*self.get_downscale_size(img.width,img.height,x,y,False),prop['quality'])
-                (offset_x,offset_y) = (int(round((img.width-x)/2)),int(round((img.height-y)/2)))
-                # jpeg lossless cropping requires (at worst) a multiple of 16x16 pixels
-                (offset_x,offset_y) = (offset_x-(offset_x % 16),offset_y-(offset_y % 16))
-                img.crop(offset_x,offset_y,x,y).save(thumb_file)
-                    
-        return thumb_file
-        
+                try:
+                    self._header = read_header(self.file_path)
+                except Exception as e:
+                    # a broken header must not prevent processing, pyexiv2 reads whatever is readable
+                    self.library.log(f'Could not read the exif header of {self.file_path}: {e}')
+                    self._header = dict(EMPTY_HEADER)
+        return self._header
+    
     @property
     def orientation(self):
-        orientation = 1
-        if 'Exif.Image.Orientation' in self.metadata:
-            orientation = self.metadata['Exif.Image.Orientation'].value
-        return orientation
+        return self.header['orientation']
         
     def save(self,force_db_update: bool=True):
         if self.changed:
             self.clean_metadata()
-            self.metadata.write(preserve_timestamps=True)
+            # setters only mark the image as possibly changed, the file is only written if the tracked tags differ
+            self.changed = self.metadata_changed or self.is_annotated != bool(self._db_row['isAnnotated'])
+        if self.changed:
+            if self.metadata_changed:
+                self.metadata.write(preserve_timestamps=True)
+                if hasattr(self,'_transformed'):
+                    # the rotated image replaced the file
+                    self._header_mtime = self.file.stat().st_mtime
+                    delattr(self,'_transformed')
+                if self.library.settings.is_synology:
+                    self.library.synoindexer.add(self.file_path)
             self.update_db_entry()
-            if self.library.settings.is_synology:
-                output = subprocess.run(['/usr/syno/bin/synoindex', '-a', self.file_path],capture_output=True)
-                if output.returncode != 0:
-                    self.library.log(f'Warning: failed to reindex file {self.file_path}')
             if self.is_new_file:
                 self.library.event('new_image',self)
+            else:
+                self.library.event('changed_image',self.index)
         elif force_db_update:
             self.update_db_entry(updateTimestamp=False)
         
+    @property
+    def sidecar_path(self):
+        return self.file_path+self.SIDECAR_EXTENSION
+    
+    def embed_sidecar(self):
+        if self.metadata.sidecar is not None:
+            self.metadata.embed()
+    
     def clean_metadata(self):
         # remove lightroom hierarchical labels
         self.metadata.pop('Xmp.lr.hierarchicalSubject',None)
-        self.changed = True
+    
+    @property
+    def metadata_changed(self):
+        return hasattr(self,'_metadata') and self._metadata.changed
     
     @property
     def labels(self):
@@ -659,9 +1092,22 @@ class _Image:
             self.metadata[key] = pyexiv2.xmp.XmpTag(key, list(set(value)))
             self.changed = True
     
+    @property
+    def locations(self):
+        locations = []
+        for tag in [tag for tag in self.LOCATION_TAGS if tag in self.metadata]:
+            value = self.metadata[tag].value
+            if type(value) == dict: # language alternatives
+                value = list(value.values())
+            locations.extend(value if type(value) == list else [value])
+        return [str(location) for location in locations]
+    
     def get_thumbnail(self,size:str='L'):
+        if not size in self.THUMBNAILS:
+            size = 'L'
         if not size in self._thumbnails:
-            self._thumbnails[size] = jpegtran.JPEGImage(self.create_thumbnail(size))
+            content = self.thumbnails.read(self,self.THUMBNAILS[size]['file_name'])
+            self._thumbnails[size] = jpegtran.JPEGImage(blob=content) if content else self.create_thumbnail(size)
         return self._thumbnails[size]
     
     def add_face(self,rect:List[float],name:str=''):
@@ -697,19 +1143,12 @@ class _Image:
     @property
     def metadata(self):
         if not hasattr(self,'_metadata'):
-            self._metadata = pyexiv2.ImageMetadata(self.file_path)
-            self._metadata.read()
+            self._metadata = self._Metadata(self.file_path,self.sidecar_path,self.library.settings.metadata_mode == 'sidecar')
         return self._metadata
     
     @property
     def latlon(self):
-        if not hasattr(self,'_latlon'):
-            try:
-                self._latlon = (dms_to_decimal(self.metadata['Exif.GPSInfo.GPSLatitude'].value ,self.metadata['Exif.GPSInfo.GPSLatitudeRef'].value),
-                                dms_to_decimal(self.metadata['Exif.GPSInfo.GPSLongitude'].value,self.metadata['Exif.GPSInfo.GPSLongitudeRef'].value))
-            except:
-                self._latlon = None
-        return self._latlon
+        return self.header['latlon']
                     
     def process(self,
                  vision_features: dict=ImageLibrary.DEFAULT_SETTINGS['vision_features'],
@@ -718,12 +1157,12 @@ class _Image:
                  replace_labels: bool=ImageLibrary.DEFAULT_SETTINGS['replace_labels'],
                  rotate_images: bool=ImageLibrary.DEFAULT_SETTINGS['rotate_images'],
                  reannotate: bool=False):
-        if self.library.settings.is_synology:
-            self.create_all_thumbnails()
-            
         if rotate_images:
             self.remove_exif_orientation()
             
+        if self.library.settings.is_synology:
+            self.create_all_thumbnails()
+            
         if not self.is_annotated or reannotate:
             if not hasattr(self.library,'gapi'):
                 self.library.log('GAPI not initialized')
@@ -753,8 +1192,132 @@ class _Image:
             self.library.log ('Found {} label(s) and {} face(s): {}'.format(len(self.labels),len(self.faces),self.file_path))
     
         
+    class _Metadata:
+        # xmp tags are read from the sidecar if it exists (it holds a full copy of the embedded xmp), all other tags
+        # from the image. In sidecar mode xmp changes are only written to the sidecar instead of rewriting the whole image,
+        # otherwise an existing sidecar is embedded with the next write.
+        TRACKED_TAGS = ('Xmp.dc.subject','Xmp.MP.RegionInfo','Xmp.lr.hierarchicalSubject')
+        SIDECAR_TEMPLATE = b'<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?><x:xmpmeta xmlns:x="adobe:ns:meta/"></x:xmpmeta><?xpacket end="w"?>'
+        
+        def __init__(self,file_path: str,sidecar_path: str,use_sidecar: bool=False,buffer: bytes=None):
+            self.file_path = file_path
+            self.sidecar_path = sidecar_path
+            self.use_sidecar = use_sidecar
+            # a buffer holds new image data (e.g. a lossless rotation), which replaces the file with the next write
+            self.buffered = buffer is not None
+            if self.buffered:
+                self.embedded = self._from_buffer(buffer)
+            else:
+                self.embedded = pyexiv2.ImageMetadata(file_path)
+                self.embedded.read()
+            self.sidecar = None
+            self.embedded_changed = self.buffered # non xmp tags are always written to the image
+            if os.path.exists(sidecar_path):
+                with open(sidecar_path,'rb') as f:
+                    self.sidecar = self._from_buffer(f.read())
+            self.snapshot = self._tracked()
+                    
+        def _from_buffer(self,buffer: bytes):
+            metadata = pyexiv2.ImageMetadata.from_buffer(buffer)
+            metadata.read()
+            return metadata
+            
+        def _target(self,key: str,write: bool=False):
+            if not key.startswith('Xmp.'):
+                self.embedded_changed = self.embedded_changed or write
+                return self.embedded
+            if write and self.use_sidecar and self.sidecar is None:
+                # sidecars start as a copy of the embedded xmp, the file is created with the next write
+                self.sidecar = self._from_buffer(self.SIDECAR_TEMPLATE)
+                self.embedded.copy(self.sidecar,exif=False,iptc=False,xmp=True,comment=False)
+            return self.sidecar if self.sidecar is not None else self.embedded
+        
+        def _tracked(self):
+            # labels and face regions, the order of bag values is irrelevant
+            tracked = {}
+            for key in [key for key in self.xmp_keys if key.startswith(self.TRACKED_TAGS)]:
+                value = self[key].raw_value
+                tracked[key] = sorted(value) if type(value) == list else value
+            return tracked
+        
+        @property
+        def changed(self):
+            return self.embedded_changed or self._tracked() != self.snapshot
+        
+        @property
+        def xmp_keys(self):
+            return (self.sidecar if self.sidecar is not None else self.embedded).xmp_keys
+        
+        def __contains__(self,key: str):
+            return key in self._target(key)
+        
+        def __getitem__(self,key: str):
+            return self._target(key)[key]
+        
+        def __setitem__(self,key: str,value):
+            self._target(key,True)[key] = value
+        
+        def __delitem__(self,key: str):
+            del self._target(key,True)[key]
+        
+        def pop(self,key: str,default=None):
+            if not key in self:
+                return default
+            value = self[key]
+            del self[key]
+            return value
+        
+        def write(self,preserve_timestamps: bool=True):
+            if self.use_sidecar:
+                if self.sidecar is not None:
+                    self.sidecar.write()
+                    self._replace(self.sidecar_path,self.sidecar.buffer)
+                if self.embedded_changed:
+                    self._write_embedded(preserve_timestamps)
+            elif self.sidecar is not None:
+                self.embed(preserve_timestamps)
+            else:
+                self._write_embedded(preserve_timestamps)
+            self.embedded_changed = False
+            self.snapshot = self._tracked()
+                
+        def embed(self,preserve_timestamps: bool=True):
+            self.sidecar.copy(self.embedded,exif=False,iptc=False,xmp=True,comment=False)
+            self._write_embedded(preserve_timestamps)
+            os.remove(self.sidecar_path)
+            self.sidecar = None
+            
+        def _write_embedded(self,preserve_timestamps: bool=True):
+            if self.buffered:
+                # the file content changes anyway, therefore its timestamps are not preserved
+                self.embedded.write()
+                self._replace(self.file_path,self.embedded.buffer)
+            else:
+                self.embedded.write(preserve_timestamps=preserve_timestamps)
+        
+        @staticmethod
+        def _replace(path: str,data: bytes):
+            # write to a temporary file and rename it, so readers never see a partially written file,
+            # the replaced file keeps the mode and owner of the original
+            try:
+                with open(path+'.tmp','wb') as f:
+                    f.write(data)
+                if os.path.exists(path):
+                    shutil.copymode(path,path+'.tmp')
+                    stat = os.stat(path)
+                    try:
+                        os.chown(path+'.tmp',stat.st_uid,stat.st_gid)
+                    except PermissionError:
+                        pass
+                os.replace(path+'.tmp',path)
+            except:
+                if os.path.exists(path+'.tmp'):
+                    os.remove(path+'.tmp')
+                raise
+        
     class _Face:
         THUMBNAIL_SIZE = (150,150)
+        THUMBNAIL_NAME = 'face_{index}.jpg'
         LOSSLESS = False
         
         def __init__(self,image,index:int,name:str=None,rect:List[float]=None):
@@ -786,8 +1349,8 @@ class _Image:
             return f'Xmp.MP.RegionInfo/MPRI:Regions[{self.index}]/MPReg:Ignored'
                 
         @property
-        def thumbnail_file(self):
-            return os.path.join(self.image.thumb_path,f'face_{self.index}.jpg')
+        def thumbnail_name(self):
+            return self.THUMBNAIL_NAME.format(index=self.index)
         
         def clear_tags(self):
             self.image.metadata.pop(self.rect_tag,None)
@@ -797,8 +1360,7 @@ class _Image:
         def delete(self):
             # clear metadata and remove thumbnail
             self.clear_tags()
-            if os.path.exists(self.thumbnail_file):
-                os.remove(self.thumbnail_file)
+            self.image.thumbnails.remove(self.image,self.thumbnail_name)
             
             # update index of remaining faces
             for face in self.image.faces[self.index:]:
@@ -834,8 +1396,7 @@ class _Image:
                 self._index = value
             else:
                 #remove thumbnail if exists
-                if os.path.exists(self.thumbnail_file):
-                    os.remove(self.thumbnail_file)
+                self.image.thumbnails.remove(self.image,self.thumbnail_name)
                 
                 #backup data
                 name = self.name
@@ -853,10 +1414,8 @@ class _Image:
             
         @property
         def name(self):
-            if self.rect and not self.name_tag in self.image.metadata:
-                self.name = '' # add missing name tag
             if not self.name_tag in self.image.metadata:
-                return None
+                return '' if self.rect else None
             return self.image.metadata[self.name_tag].value
         
         @name.setter
@@ -869,21 +1428,20 @@ class _Image:
         def rect(self):
             if not self.rect_tag in self.image.metadata:
                 return None
-            (x,y,w,h) = [float(x) for x in self.image.metadata[self.rect_tag].value.split(', ')]
-            
-            if any([val > 1 or val < 0 for val in [x,y,w+x,h+y]]):
-                self.rect = [x,y,w,h] # reset rect to be in range [0,1]
-                return self.rect
-            return [x,y,w,h]
+            return self.clip_rect([float(x) for x in self.image.metadata[self.rect_tag].value.split(', ')])
+        
+        @staticmethod
+        def clip_rect(values:List[float]):
+            # ensure rect is in range [0,1]
+            (x,y,w,h) = values
+            return [min(1,max(0,x)), min(1,max(0,y)), max(0,min(1,w+x)-x), max(0,min(1,h+y)-y)]
         
         @rect.setter
         def rect(self,values:List[float]):
             if hasattr(self, '_thumbnail'):
                 delattr(self,'_thumbnail')
             self.check_metadata()
-            (x,y,w,h) = values
-            # ensure rect is in range [0,1]
-            values = [min(1,max(0,x)), min(1,max(0,y)), max(0,min(1,w+x)-x), max(0,min(1,h+y)-y)]
+            values = self.clip_rect(values)
             self.image.metadata[self.rect_tag] = pyexiv2.xmp.XmpTag(self.rect_tag, '{}, {}, {}, {}'.format(*(values)))
             self.image.changed = True
             
@@ -892,8 +1450,9 @@ class _Image:
             if not self.rect:
                 raise Exception('No face tag defined')
             if not hasattr(self, '_thumbnail'):
-                if os.path.exists(self.thumbnail_file):
-                    self._thumbnail = jpegtran.JPEGImage(self.thumbnail_file)
+                content = self.image.thumbnails.read(self.image,self.thumbnail_name)
+                if content:
+                    self._thumbnail = jpegtran.JPEGImage(blob=content)
                 else:
                     if self.LOSSLESS:
                         thumb = self.image.get_thumbnail('XL')
@@ -919,6 +1478,6 @@ class _Image:
                         buffered = io.BytesIO()
                         thumb.save(buffered, format="JPEG", quality=90)
                         self._thumbnail = jpegtran.JPEGImage(blob=buffered.getvalue())
-                    self._thumbnail.save(self.thumbnail_file)
+                    self.image.thumbnails.write(self.image,self.thumbnail_name,self._thumbnail.as_blob())
                     
             return self._thumbnail
\ No newline at end of file
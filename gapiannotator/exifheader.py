@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021, Sebastian Nagel.
+#
+# This file is part of the module 'gapiannotator' and is released under
+# the MIT License: https://opensource.org/licenses/MIT
+#
+import os
+import mmap
+import struct
+from datetime import datetime
+
+from .helper import dms_to_decimal
+
+# reads date, orientation, gps position and dimensions from the exif header of a jpeg,
+# only the segments in front of the image data are touched (pyexiv2 reads the whole file)
+SOF_MARKERS = {0xC0,0xC1,0xC2,0xC3,0xC5,0xC6,0xC7,0xC9,0xCA,0xCB,0xCD,0xCE,0xCF}
+SOS_MARKER = 0xDA
+APP1_MARKER = 0xE1
+TAG_ORIENTATION = 0x0112
+TAG_EXIF_IFD = 0x8769
+TAG_GPS_IFD = 0x8825
+TAG_DATETIME_ORIGINAL = 0x9003
+TAG_PIXEL_X = 0xA002
+TAG_PIXEL_Y = 0xA003
+TAG_GPS_LATITUDE_REF = 1
+TAG_GPS_LATITUDE = 2
+TAG_GPS_LONGITUDE_REF = 3
+TAG_GPS_LONGITUDE = 4
+TYPE_SIZES = {1:1, 2:1, 3:2, 4:4, 5:8, 7:1, 9:4, 10:8}
+DATE_FORMAT = '%Y:%m:%d %H:%M:%S'
+EMPTY_HEADER = {'date': None, 'orientation': 1, 'latlon': None, 'width': None, 'height': None}
+
+def read_header(file_path: str):
+    header = dict(EMPTY_HEADER)
+    with open(file_path,'rb') as f:
+        if os.fstat(f.fileno()).st_size < 4:
+            return header
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if data[0:2] != b'\xff\xd8':
+                return header
+            pos = 2
+            while pos + 4 <= len(data):
+                if data[pos] != 0xFF:
+                    break
+                marker = data[pos+1]
+                if marker == 0xFF: # fill byte
+                    pos += 1
+                    continue
+                (length,) = struct.unpack('>H',data[pos+2:pos+4])
+                if marker == APP1_MARKER and data[pos+4:pos+10] == b'Exif\x00\x00':
+                    try:
+                        _parse_tiff(data[pos+10:pos+2+length],header)
+                    except (struct.error, LookupError, ValueError, TypeError, ZeroDivisionError):
+                        pass
+                elif marker in SOF_MARKERS:
+                    if pos + 9 <= len(data): # truncated files end within the frame header
+                        (header['height'], header['width']) = struct.unpack('>HH',data[pos+5:pos+9])
+                    break
+                elif marker == SOS_MARKER:
+                    break
+                pos += 2 + length
+    return header
+
+def _parse_tiff(tiff: bytes,header: dict):
+    order = {b'II': '<', b'MM': '>'}[tiff[0:2]]
+    (ifd0,) = struct.unpack(order+'I',tiff[4:8])
+    tags = _read_ifd(tiff,order,ifd0)
+    # malformed files may store any tag with an unexpected type, those tags are ignored
+    if _is_number(tags.get(TAG_ORIENTATION)):
+        header['orientation'] = tags[TAG_ORIENTATION][0]
+    if _is_number(tags.get(TAG_EXIF_IFD)):
+        exif = _read_ifd(tiff,order,tags[TAG_EXIF_IFD][0])
+        if isinstance(exif.get(TAG_DATETIME_ORIGINAL),str):
+            try:
+                header['date'] = datetime.strptime(exif[TAG_DATETIME_ORIGINAL],DATE_FORMAT).timestamp()
+            except ValueError: # zeroed date
+                pass
+        if _is_number(exif.get(TAG_PIXEL_X)) and _is_number(exif.get(TAG_PIXEL_Y)):
+            (header['width'], header['height']) = (exif[TAG_PIXEL_X][0], exif[TAG_PIXEL_Y][0])
+    if _is_number(tags.get(TAG_GPS_IFD)):
+        gps = _read_ifd(tiff,order,tags[TAG_GPS_IFD][0])
+        if (all([isinstance(gps.get(tag),str) for tag in [TAG_GPS_LATITUDE_REF,TAG_GPS_LONGITUDE_REF]]) and
+            all([_is_number(gps.get(tag),3) for tag in [TAG_GPS_LATITUDE,TAG_GPS_LONGITUDE]])):
+            header['latlon'] = (dms_to_decimal(gps[TAG_GPS_LATITUDE],gps[TAG_GPS_LATITUDE_REF]),
+                                dms_to_decimal(gps[TAG_GPS_LONGITUDE],gps[TAG_GPS_LONGITUDE_REF]))
+
+def _is_number(value,count: int=1):
+    return isinstance(value,tuple) and len(value) >= count
+
+def _read_ifd(tiff: bytes,order: str,offset: int):
+    # returns {tag: value} with ascii values as str and all others as tuples
+    tags = {}
+    (count,) = struct.unpack(order+'H',tiff[offset:offset+2])
+    for entry in range(offset+2,offset+2+count*12,12):
+        (tag, type, num) = struct.unpack(order+'HHI',tiff[entry:entry+8])
+        if not type in TYPE_SIZES:
+            continue
+        size = TYPE_SIZES[type]*num
+        if size <= 4:
+            value = tiff[entry+8:entry+8+size]
+        else:
+            (pointer,) = struct.unpack(order+'I',tiff[entry+8:entry+12])
+            value = tiff[pointer:pointer+size]
+        if type == 2:
+            tags[tag] = value.split(b'\x00',1)[0].decode('ascii',errors='ignore').strip()
+        elif type in [5,10]:
+            values = struct.unpack(order+('I' if type == 5 else 'i')*(2*num),value)
+            tags[tag] = tuple([values[i]/values[i+1] for i in range(0,len(values),2)])
+        else:
+            fmt = {1:'B', 3:'H', 4:'I', 7:'B', 9:'i'}[type]
+            tags[tag] = struct.unpack(order+fmt*num,value)
+    return tags
@@ -6,6 +6,7 @@
 # the MIT License: https://opensource.org/licenses/MIT
 #
 import os, errno
+import re
 from typing import Tuple
 
 import googlemaps
@@ -153,17 +154,21 @@ class Gapi():
                 self._checkTable()
             
             def _checkTable(self):
+                # column names can not be bound as parameters, therefore only valid language codes are accepted
+                if not re.match(r'^[a-zA-Z]{2,3}(-[a-zA-Z]{2})?$', self._target_language):
+                    raise ValueError(f'Invalid target language {self._target_language}')
+                self._column = '"{}"'.format(self._target_language)
                 self._db.execute(f"""CREATE TABLE IF NOT EXISTS translation(
                     id INTEGER PRIMARY KEY,
                     source TEXT NOT NULL UNIQUE,
-                    {self._target_language} TEXT);""",True)
+                    {self._column} TEXT);""",commit=True)
                 
                 # check if translation column exists
-                lang_exists = bool(self._db.execute(f"SELECT COUNT(*) AS CNTREC FROM pragma_table_info('translation') WHERE name='{self._target_language}';").fetchone()[0])
+                lang_exists = bool(self._db.execute("SELECT COUNT(*) AS CNTREC FROM pragma_table_info('translation') WHERE name=?;",(self._target_language,)).fetchone()[0])
                 if (not lang_exists):
-                    self._db.execute(f"ALTER TABLE translation ADD {self._target_language} TEXT;",True)
+                    self._db.execute(f"ALTER TABLE translation ADD {self._column} TEXT;",commit=True)
                     
-                self._translatecache = {key : value for (key,value) in self._db.execute(f"SELECT source, {self._target_language} FROM translation WHERE {self._target_language} IS NOT NULL;").fetchall()}
+                self._translatecache = {key : value for (key,value) in self._db.execute(f"SELECT source, {self._column} FROM translation WHERE {self._column} IS NOT NULL;").fetchall()}
         
             def _get_cache(self,key:str):
                 return self._translatecache[key]
@@ -171,12 +176,10 @@ class Gapi():
             def _set_cache(self,key:str,value:str):
                 if not key in self._translatecache:
                     self._translatecache[key] = value
-                    esc_key = key.replace("'", "''")
-                    esc_value = value.replace("'", "''")
                     try:
-                        self._db.execute(f"INSERT INTO translation (source, {self._target_language}) VALUES ('{esc_key}','{esc_value}');",True)
+                        self._db.execute_deferred(f"INSERT INTO translation (source, {self._column}) VALUES (?,?);",(key,value))
                     except:
-                        self._db.execute(f"UPDATE translation SET {self._target_language} = '{esc_value}' WHERE source = '{esc_key}';",True)
+                        self._db.execute_deferred(f"UPDATE translation SET {self._column} = ? WHERE source = ?;",(value,key))
             
             def __getattr__(self,key:str):
                 if key.startswith('_'):
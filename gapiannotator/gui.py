@@ -11,6 +11,12 @@ import re
 import mimetypes
 import threading
 import traceback
+import hashlib
+import functools
+import gzip
+import collections
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 
 import asyncio
 import aiohttp
@@ -19,21 +25,57 @@ import sass
 
 from . import PKG_ROOT
 from .gapi import Gapi
+from .helper import LRUCache
 
 FACE_TYPES = ['untagged','ignored','all']
+IMAGE_CACHE_CONTROL = 'no-cache' # browsers have to revalidate with the ETag
+# blocking work (sqlite, pyexiv2, jpegtran) runs on bounded executors, metadata writes on a separate pool
+READ_WORKERS = 4
+WRITE_WORKERS = 1
+WRITE_COMMANDS = ['save_settings','name_faces','ignore_faces','delete_faces','delete_duplicates','keep_duplicates']
+# responses of queries are only sent to the requesting client
+QUERY_COMMANDS = ['search']
+IMAGE_TIMEOUT = 30
+API_TIMEOUT = 300
+STATIC_CACHE_CONTROL = 'no-cache'
+COMPRESSIBLE_TYPES = r'^(text/|application/(javascript|json)|image/(svg\+xml|x-icon|vnd.microsoft.icon))'
+# every websocket has its own outbound queue, clients which can not keep up are disconnected
+CLIENT_QUEUE_SIZE = 1000
+CLIENT_SEND_TIMEOUT = 30
+MERGED_COMMANDS = ['remaining_files','clean_progress'] # only the latest pending message of these commands is sent
+# high frequency broadcasts are collected and sent as one 'batch' message at most EVENT_RATE times per second
+COALESCED_COMMANDS = ['remaining_files','new_log_entry','job_progress','clean_progress']
+EVENT_RATE = 4
+# bulk face operations update the db at once and write the metadata in the background
+JOB_WORKERS = 4
 
 
 class WebGUIServer(threading.Thread):
     def __init__(self,
                  library,
                  addr: str='0.0.0.0',
-                 port: int=8000):
+                 port: int=8000,
+                 dev: bool=False):
         self.library = library
         self.addr = addr
         self.port = port
-        self.html = WebGUIServer._fileloader('web-templates','.html')
-        self.htdocs = WebGUIServer._fileloader('.',mode='rb',return_mime=True)
-        self.websockets = []
+        # static assets are compiled and compressed once, in dev mode they are reloaded on file change
+        self.html = WebGUIServer._assets('web-templates',dev,
+                                         lambda name,content: content.decode('utf-8').format(content="").encode('utf-8')) # content will be set dynamically on the javascript side
+        self.htdocs = WebGUIServer._assets('web',dev)
+        self.clients = {}
+        self._coalesced = []
+        self._flush_handle = None
+        self._last_flush = 0
+        self.image_cache = LRUCache(int(self.library.settings.thumbnail_cache_size)*1024*1024)
+        self.executor = ThreadPoolExecutor(max_workers=READ_WORKERS, thread_name_prefix='gui-read')
+        self.write_executor = ThreadPoolExecutor(max_workers=WRITE_WORKERS, thread_name_prefix='gui-write')
+        self.job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='gui-job')
+        self.jobs = {}
+        self._job_ids = itertools.count(1)
+        self._jobs_lock = threading.Lock()
+        self._face_chains = {} # image -> pending face jobs, they run strictly in submission order
+        self._face_chain_events = {} # image -> asyncio.Event, set once all face jobs of the image are done (server loop only)
         self.checkTable()
         self.add_listeners()
         
@@ -45,13 +87,21 @@ class WebGUIServer(threading.Thread):
             self.websocket_send_all({'cmd':'new_log_entry','data':message}))
         self.library.event.add('remaining_files',lambda num_files:
             self.websocket_send_all({'cmd':'remaining_files','data':num_files}))
+        self.library.event.add('clean_progress',lambda progress:
+            self.websocket_send_all({'cmd':'clean_progress','data':progress}))
         self.library.event.add('new_image',self.new_image)
-        self.library.event.add('deleted_image',lambda imgindex:
-            self.websocket_send_all({'cmd':'deleted_image', 'data':imgindex}))
+        self.library.event.add('deleted_image',self.deleted_image)
+        self.library.event.add('changed_image',self.invalidate_image_cache)
+        
+    def deleted_image(self,imgindex):
+        self.invalidate_image_cache(imgindex)
+        self.websocket_send_all({'cmd':'deleted_image', 'data':imgindex})
         
     def new_image(self,image):
+        self.invalidate_image_cache(image.index)
         faces = image.untagged_faces
         if (faces):
+            self.library.db.flush() # the new image has to be readable by the clients
             data = [{
                     'index': image.index,
                     'src': f"./image/{image.index}",
@@ -65,7 +115,7 @@ class WebGUIServer(threading.Thread):
     def checkTable(self):
         self.library.db.execute("""CREATE TABLE IF NOT EXISTS knownnames(
             id INTEGER PRIMARY KEY,
-            name TEXT NOT NULL UNIQUE);""",True)
+            name TEXT NOT NULL UNIQUE);""",commit=True)
     
     def run(self):
         self.library.log(f'Staring WebGUIServer on port {self.port}')
@@ -89,93 +139,117 @@ class WebGUIServer(threading.Thread):
         site = web.TCPSite(runner, self.addr, self.port)
         await site.start()
         
-    def websocket_send_all(self,data):
-        message = json.dumps(data)
+    async def run_blocking(self,func,*args,executor=None,timeout=API_TIMEOUT):
+        # raises asyncio.TimeoutError if func does not return in time (the executor thread will still finish its work)
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(executor or self.executor, functools.partial(func,*args)), timeout)
+        
+    def _call_on_loop(self,func,*args):
+        # hands func over to the server loop, callers in worker threads never wait for the delivery
         try:
             loop = asyncio.get_running_loop()
         except RuntimeError:
             loop = None
         
-        if loop and loop.is_running():
-            loop.create_task(self._websocket_send_all(message))
-        else:
-            asyncio.run(self._websocket_send_all(message))
+        if loop and loop is getattr(self,'loop',None):
+            func(*args)
+        elif hasattr(self,'loop') and self.loop.is_running():
+            self.loop.call_soon_threadsafe(func,*args)
+        # else: server not running, there are no websockets to send to
+        
+    def websocket_send_all(self,data):
+        self._call_on_loop(self._websocket_send_all,data)
             
     def websocket_send_single(self,ws,data):
-        message = json.dumps(data)
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = None
+        self._call_on_loop(self._websocket_send_single,ws,data)
         
-        if loop and loop.is_running():
-            loop.create_task(self._websocket_send_single(ws,message))
-        else:
-            asyncio.run(self._websocket_send_single(ws,message))
+    def _websocket_send_all(self, data):
+        if data['cmd'] in COALESCED_COMMANDS:
+            if data['cmd'] in MERGED_COMMANDS:
+                self._coalesced = [pending for pending in self._coalesced if pending['cmd'] != data['cmd']]
+            self._coalesced.append(data)
+            if not self._flush_handle:
+                delay = max(0, self._last_flush + 1/EVENT_RATE - self.loop.time())
+                self._flush_handle = self.loop.call_later(delay, self._flush_coalesced)
+            return
+        self._broadcast(data['cmd'], json.dumps(data))
+    
+    def _flush_coalesced(self):
+        (pending, self._coalesced) = (self._coalesced, [])
+        self._flush_handle = None
+        self._last_flush = self.loop.time()
+        if len(pending) == 1:
+            self._broadcast(pending[0]['cmd'], json.dumps(pending[0]))
+        elif pending:
+            self._broadcast('batch', json.dumps({'cmd': 'batch', 'data': pending}))
         
-    async def _websocket_send_all(self, message):
-        for ws in self.websockets:
-            await self._websocket_send_single(ws, message)
+    def _broadcast(self, cmd, message):
+        # only queues the message, every client is served by its own sender task
+        for client in list(self.clients.values()):
+            client.send(cmd, message)
                 
-    async def _websocket_send_single(self, ws, message):
-        try:
-            await ws.send_str(message)
-        except ConnectionResetError:
-            #print('Connection lost to websocket')
-            try:
-                self.websockets.remove(ws)
-            except:
-                pass
+    def _websocket_send_single(self, ws, data):
+        if ws in self.clients:
+            self.clients[ws].send(data['cmd'], json.dumps(data))
     
     async def websocket_handler(self,request):
         ws = web.WebSocketResponse()
         await ws.prepare(request)
         
-        self.websockets.append(ws)
+        self.clients[ws] = WebGUIServer._client(ws)
+        calls = asyncio.Queue()
+        worker = asyncio.ensure_future(self.websocket_api_worker(calls,ws))
     
         async for msg in ws:
             if msg.type == aiohttp.WSMsgType.TEXT:
                 if msg.data == 'close':
                     await ws.close()
                 else:
-                    try:
-                        data = json.loads(msg.data)
-                        self.api_call(data['cmd'],data['data'],ws)
-                    except:
-                        print('Api call failed with data: {}'.format(msg.data))
-                        traceback.print_exc() 
+                    calls.put_nowait(msg.data)
                         
             elif msg.type == aiohttp.WSMsgType.ERROR:
                 print('ws connection closed with exception %s' % ws.exception())
-        self.websockets.remove(ws)
+        worker.cancel()
+        self.clients.pop(ws).stop()
         
         return ws
     
+    async def websocket_api_worker(self,calls,ws):
+        # the calls of one websocket are answered in order, a slow call does not block
+        # the receiving loop, other websockets or image requests (they run on the executors)
+        while True:
+            message = await calls.get()
+            await self.websocket_api_call(message,ws)
+    
+    async def websocket_api_call(self,message,ws):
+        try:
+            data = json.loads(message)
+            await self.async_api_call(data['cmd'],data['data'],ws)
+        except asyncio.TimeoutError:
+            print('Api call timed out with data: {}'.format(message))
+        except:
+            print('Api call failed with data: {}'.format(message))
+            traceback.print_exc() 
+    
     def get_files(self,face_type='untagged',limit=-1,lastimageid=None):
-        if face_type == 'untagged':
-            where = 'hasUntaggedFaces=1'
-        elif face_type == 'ignored':
-            where = 'hasIgnoredFaces=1'
-        elif face_type == 'all':
-            where = 'hasFaces=1'
+        where = {'untagged': 'hasUntaggedFaces=1',
+                 'ignored': 'hasIgnoredFaces=1',
+                 'all': 'hasFaces=1'}[face_type]
             
         order = 'modifedTimesamp DESC, id DESC'
         
+        # keyset pagination, the last image is included since it may have further faces
         if lastimageid:
-            sql = f"""SELECT filePath FROM files 
-                      WHERE {where}
-                      ORDER BY {order}
-                      LIMIT {limit} OFFSET 
-                          (SELECT RowNum-1 FROM 
-                               (SELECT ROW_NUMBER () OVER (ORDER BY {order}) RowNum, id FROM files 
-                                WHERE {where}
-                                ORDER BY {order})
-                           WHERE id = {lastimageid})"""
+            sql = f"""SELECT id, facesIndexed FROM files 
+                      WHERE {where} AND (modifedTimesamp, id) <= (SELECT modifedTimesamp, id FROM files WHERE id = ?)
+                      ORDER BY {order} LIMIT ?;"""
+            params = (lastimageid,limit)
         else:
-            sql = f"SELECT filePath FROM files WHERE {where} ORDER BY {order} LIMIT {limit};"
+            sql = f"SELECT id, facesIndexed FROM files WHERE {where} ORDER BY {order} LIMIT ?;"
+            params = (limit,)
         
         try:
-            return [file_path for (file_path,) in self.library.db.execute(sql).fetchall()]
+            return self.library.db.execute(sql,params).fetchall()
         except:
             return []
     
@@ -189,75 +263,159 @@ class WebGUIServer(threading.Thread):
     def known_names(self,value):
         if not value in self.known_names:
             self._known_names.append(value)
-            self.library.db.execute(f"INSERT INTO knownnames (name) VALUES ('{value}');",True)
+            self.library.db.execute("INSERT INTO knownnames (name) VALUES (?);",(value,),commit=True)
     
     def ignore_faces(self,images):
-        response = []
-        for imgindex, faces in images.items():
-            file_path=self.library.db.execute(f"SELECT filePath FROM files WHERE id={imgindex};").fetchone()
-            if file_path and os.path.exists(file_path[0]):
-                img = self.library.get_image(file_path[0])
-                for faceidx in faces:
-                    img.faces[faceidx-1].ignore()
-                img.save()
-                response.append({
-                    'index': img.index,
-                    'src': f"./image/{img.index}",
-                    'faces': [{'index':faceidx, 
-                               'name':img.faces[faceidx-1].name,
-                               'ignored':img.faces[faceidx-1].ignored,
-                               'src': f"./image/{img.index}/face/{faceidx}"} 
-                              for faceidx in faces]
-                    })
+        images = {int(imgindex): faces for imgindex, faces in images.items()}
+        response = self.update_faces_optimistically('ignore_faces',images)
+        self.submit_face_job('ignore_faces',images)
         return response
     
     def delete_faces(self,images):
-        response = []
-        for imgindex, faces in images.items():
-            file_path=self.library.db.execute(f"SELECT filePath FROM files WHERE id={imgindex};").fetchone()
-            if file_path and os.path.exists(file_path[0]):
-                img = self.library.get_image(file_path[0])
-                faces.sort(reverse=True)
-                for faceidx in faces:
-                    img.faces[faceidx-1].delete()
-                img.save()
-                response.append({
-                    'index': img.index,
-                    'src': f"./image/{img.index}",
-                    'faces': [{'index':face.index, 
-                               'name':face.name,
-                               'ignored':face.ignored,
-                               'src': f"./image/{img.index}/face/{face.index}"} 
-                              for face in img.faces] # return remaining faces on delete
-                    })
+        images = {int(imgindex): faces for imgindex, faces in images.items()}
+        response = self.update_faces_optimistically('delete_faces',images)
+        self.submit_face_job('delete_faces',images)
         return response
     
     def name_faces(self,images,name):
+        images = {int(imgindex): faces for imgindex, faces in images.items()}
+        response = self.update_faces_optimistically('name_faces',images,name)
+        self.submit_face_job('name_faces',images,name)
+        self.known_names = name
+        return response
+    
+    def update_faces_optimistically(self,cmd,images,name=None):
+        # optimistic update of the faces table and the face flags, so the clients see the change at once,
+        # the face job writes the metadata and stores the actual faces of each image afterwards
+        db = self.library.db
         response = []
         for imgindex, faces in images.items():
-            file_path=self.library.db.execute(f"SELECT filePath FROM files WHERE id={imgindex};").fetchone()
-            if file_path and os.path.exists(file_path[0]):
+            # faces of images which were annotated before the faces table existed are indexed first (see load_faces)
+            indexed = db.execute("SELECT facesIndexed FROM files WHERE id = ?;",(imgindex,)).fetchone()
+            if indexed and not indexed[0]:
+                [record.to_image(self.library).update_faces_table() for record in self.library.get_records(ids=[imgindex])]
+            # the update of an image is committed as a whole, no other write can interleave
+            with db.group():
+                db.flush() # the faces are read on another connection, which has to see the previous optimistic updates
+                rows = {faceindex: (facename,ignored) for (faceindex,facename,ignored) in 
+                        db.execute("SELECT faceIndex, name, ignored FROM faces WHERE imageId = ? ORDER BY faceIndex;",(imgindex,)).fetchall()}
+                faces = [faceidx for faceidx in faces if faceidx in rows]
+                if not faces:
+                    continue
+                placeholders = ', '.join('?'*len(faces))
+                if cmd == 'delete_faces':
+                    db.execute_deferred(f"DELETE FROM faces WHERE imageId = ? AND faceIndex IN ({placeholders});",(imgindex,*faces))
+                    # remaining faces move up (ascending, so the new index is always free)
+                    remaining = [faceidx for faceidx in sorted(rows) if not faceidx in faces]
+                    for (newidx, faceidx) in enumerate(remaining,1):
+                        if newidx != faceidx:
+                            db.execute_deferred("UPDATE faces SET faceIndex = ? WHERE imageId = ? AND faceIndex = ?;",(newidx,imgindex,faceidx))
+                    result = [(newidx,*rows[faceidx]) for (newidx, faceidx) in enumerate(remaining,1)] # return remaining faces on delete
+                    # cached thumbnails of the renumbered faces show other faces now
+                    first = min(faces)
+                    self.image_cache.invalidate(lambda key: key[0] == imgindex and key[1] and key[1] >= first)
+                else:
+                    (facename, ignored) = (name, 0) if cmd == 'name_faces' else ('', 1)
+                    db.execute_deferred(f"UPDATE faces SET name = ?, ignored = ? WHERE imageId = ? AND faceIndex IN ({placeholders});",(facename,ignored,imgindex,*faces))
+                    result = [(faceidx,facename,ignored) for faceidx in faces]
+                db.execute_deferred("""UPDATE files SET 
+                                           hasFaces = EXISTS(SELECT 1 FROM faces WHERE imageId = files.id),
+                                           hasUntaggedFaces = EXISTS(SELECT 1 FROM faces WHERE imageId = files.id AND name = '' AND ignored = 0),
+                                           hasIgnoredFaces = EXISTS(SELECT 1 FROM faces WHERE imageId = files.id AND ignored = 1)
+                                       WHERE id = ?;""",(imgindex,))
+            response.append({
+                'index': imgindex,
+                'src': f"./image/{imgindex}",
+                'faces': [{'index':faceidx, 
+                           'name':facename,
+                           'ignored':bool(ignored),
+                           'src': f"./image/{imgindex}/face/{faceidx}"} 
+                          for (faceidx,facename,ignored) in result]
+                })
+        return response
+    
+    def submit_face_job(self,cmd,images,name=None):
+        job = {'id': next(self._job_ids), 'cmd': cmd, 'total': len(images), 'done': 0, 'failed': 0}
+        with self._jobs_lock:
+            self.jobs[job['id']] = job
+            for imgindex, faces in images.items():
+                # the face indexes of a job refer to the faces after all previous jobs of the image
+                chain = self._face_chains.setdefault(imgindex,collections.deque())
+                chain.append((job,faces,name))
+                if len(chain) == 1:
+                    self.job_executor.submit(self.run_face_chain,imgindex)
+        return job
+    
+    def run_face_chain(self,imgindex):
+        # runs the first pending job of the image, the next one is submitted once it is done
+        with self._jobs_lock:
+            (job, faces, name) = self._face_chains[imgindex][0]
+        try:
+            self.run_face_job(job,imgindex,faces,name)
+        finally:
+            self.invalidate_image_cache(imgindex)
+            with self._jobs_lock:
+                chain = self._face_chains[imgindex]
+                chain.popleft()
+                if chain:
+                    self.job_executor.submit(self.run_face_chain,imgindex)
+                else:
+                    del self._face_chains[imgindex]
+                    self._call_on_loop(self._face_chain_done,imgindex)
+    
+    def _face_chain_done(self,imgindex):
+        if imgindex in self._face_chain_events:
+            self._face_chain_events.pop(imgindex).set()
+    
+    async def wait_for_face_jobs(self,imgindex,timeout=IMAGE_TIMEOUT):
+        # the faces of an image with pending face jobs might be renumbered, the file is the reference again once they are done
+        with self._jobs_lock:
+            if not imgindex in self._face_chains:
+                return
+        # the chain can not be done before this event is registered, _face_chain_done runs on this loop afterwards
+        event = self._face_chain_events.setdefault(imgindex,asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(),timeout)
+        except asyncio.TimeoutError:
+            pass
+    
+    def run_face_job(self,job,imgindex,faces,name=None):
+        failed = False
+        file_path = self.library.db.execute("SELECT filePath FROM files WHERE id=?;",(imgindex,)).fetchone()
+        if file_path and os.path.exists(file_path[0]):
+            try:
                 img = self.library.get_image(file_path[0])
-                for faceidx in faces:
-                    img.faces[faceidx-1].name = name
-                    img.faces[faceidx-1].ignored = False
+                if job['cmd'] == 'delete_faces':
+                    for faceidx in sorted(faces,reverse=True):
+                        img.faces[faceidx-1].delete()
+                elif job['cmd'] == 'ignore_faces':
+                    for faceidx in faces:
+                        img.faces[faceidx-1].ignore()
+                else:
+                    for faceidx in faces:
+                        img.faces[faceidx-1].name = name
+                        img.faces[faceidx-1].ignored = False
                 img.save()
-                response.append({
-                    'index': img.index,
-                    'src': f"./image/{img.index}",
-                    'faces': [{'index':faceidx, 
-                               'name':img.faces[faceidx-1].name,
-                               'ignored':img.faces[faceidx-1].ignored,
-                               'src': f"./image/{img.index}/face/{faceidx}"} 
-                              for faceidx in faces]
-                    })
-        self.known_names = name
-        return response
-
+            except Exception as e:
+                failed = True
+                self.library.log(f'Failed to update the faces of {file_path[0]}: {e}')
+                try:
+                    # restore the optimistic db entries from the file
+                    self.library.get_image(file_path[0]).update_db_entry(updateTimestamp=False)
+                except:
+                    pass
+        with self._jobs_lock:
+            job['done'] += 1
+            job['failed'] += int(failed)
+            if job['done'] == job['total']:
+                self.jobs.pop(job['id'],None)
+            progress = dict(job,image=imgindex)
+        self.websocket_send_all({'cmd':'job_progress','data':progress})
+    
     def delete_duplicates(self,images):
         for idx in images:
             try:
-                (filePath,)=self.library.db.execute(f"SELECT filePath FROM files WHERE id = {idx};").fetchone()
+                (filePath,)=self.library.db.execute("SELECT filePath FROM files WHERE id = ?;",(idx,)).fetchone()
                 if os.path.exists(filePath):
                     os.remove(filePath) 
                     self.library.delete(filePath,False)
@@ -267,7 +425,7 @@ class WebGUIServer(threading.Thread):
         return None
     
     def get_image_bytes(self,imageid,faceid=None):
-        file_path=self.library.db.execute(f"SELECT filePath FROM files WHERE id={imageid};").fetchone()
+        file_path=self.library.db.execute("SELECT filePath FROM files WHERE id=?;",(imageid,)).fetchone()
         if file_path and os.path.exists(file_path[0]):
             img = self.library.get_image(file_path[0])
             if not faceid:
@@ -276,93 +434,133 @@ class WebGUIServer(threading.Thread):
                 return img.faces[faceid-1].thumbnail.as_blob()
         return b''
     
+    def get_thumbnail_file(self,imageid,faceid=None):
+        # returns the path of an already existing thumbnail file, if the thumbnail store keeps single files
+        # (resolved from the files table only, without creating an image object)
+        from .annotator import _Image
+        records = self.library.get_records(ids=[imageid])
+        if not records:
+            return None
+        if not faceid:
+            name = _Image.THUMBNAILS['B']['file_name']
+        elif self.library.db.execute("SELECT 1 FROM faces WHERE imageId = ? AND faceIndex = ?;",(imageid,faceid)).fetchone():
+            name = _Image._Face.THUMBNAIL_NAME.format(index=faceid)
+        else:
+            return None
+        thumb_file = self.library.thumbnails.file(records[0],name)
+        if thumb_file and os.path.exists(thumb_file):
+            return thumb_file
+        return None
+    
+    def get_cached_image(self,imageid,faceid=None):
+        # returns (content, etag), encoded thumbnails are kept in a LRU cache with a limited memory budget
+        key = (imageid,faceid)
+        cached = self.image_cache.get(key)
+        if cached:
+            return cached
+        content = self.get_image_bytes(imageid,faceid)
+        if not content:
+            return (content, None)
+        etag = '"{}"'.format(hashlib.sha1(content).hexdigest())
+        self.image_cache.put(key,(content,etag),len(content))
+        return (content, etag)
+    
+    def invalidate_image_cache(self,imageid):
+        self.image_cache.invalidate(lambda key: key[0] == imageid)
+        
+    async def image_response(self,request,imageid,faceid=None):
+        # stream existing thumbnail files with sendfile (supports range and conditional requests),
+        # only missing thumbnails are generated and served from memory
+        try:
+            if faceid:
+                await self.wait_for_face_jobs(imageid)
+            thumb_file = await self.run_blocking(self.get_thumbnail_file,imageid,faceid,timeout=IMAGE_TIMEOUT)
+            if thumb_file:
+                return web.FileResponse(thumb_file, headers={'Cache-Control': IMAGE_CACHE_CONTROL, 'Content-Type': 'image/jpeg'})
+            
+            (content,etag) = await self.run_blocking(self.get_cached_image,imageid,faceid,timeout=IMAGE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return web.Response(body=b'', status=504, content_type='image/jpeg')
+        if not content:
+            return web.Response(body=b'', status=404, content_type='image/jpeg')
+        headers = {'ETag': etag, 'Cache-Control': IMAGE_CACHE_CONTROL}
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=content, status=200, content_type='image/jpeg', headers=headers)
+    
     def load_faces(self,numfaces=50,lastimageid=None,lastfaceid=None,facetype=FACE_TYPES[0]):
         data = []
         if not facetype in FACE_TYPES:
             facetype = FACE_TYPES[0]
         
+        # every listed image has at least one matching face, so numfaces images are sufficient
         files = self.get_files(facetype,numfaces,lastimageid)
-        images = self.library.get_images(files)
+        if not files:
+            return data
+        
+        # faces of images which were annotated before the faces table existed are indexed once
+        records = self.library.get_records(ids=[imgindex for (imgindex,indexed) in files if not indexed])
+        for record in records:
+            record.to_image(self.library).update_faces_table()
+        if records:
+            self.library.db.flush() # the backfilled faces are read on another connection
+        
+        face_filter = {'untagged': "name = '' AND ignored = 0",
+                       'ignored': "ignored = 1",
+                       'all': "1"}[facetype]
+        ids = [imgindex for (imgindex,indexed) in files]
+        faces = {}
+        for (imgindex,faceindex,name,ignored) in self.library.db.execute(f"""SELECT imageId, faceIndex, name, ignored FROM faces
+                                                                             WHERE imageId IN ({', '.join('?'*len(ids))}) AND {face_filter}
+                                                                             ORDER BY faceIndex;""",ids).fetchall():
+            if imgindex == lastimageid and faceindex <= lastfaceid:
+                continue
+            faces.setdefault(imgindex,[]).append({'index':faceindex,
+                                                  'name':name,
+                                                  'ignored':bool(ignored),
+                                                  'src': f"./image/{imgindex}/face/{faceindex}"})
         faceidx = 0
-        for image in images:
+        for (imgindex,indexed) in files:
+            if not imgindex in faces:
+                continue
+            image_faces = faces[imgindex][:numfaces-faceidx]
+            data.append({
+                'index': imgindex,
+                'src': f"./image/{imgindex}",
+                'faces': image_faces
+                })
+            faceidx += len(image_faces)
             if faceidx >= numfaces: break
-        
-            if facetype == 'untagged':
-                faces = image.untagged_faces
-            elif facetype == 'ignored':
-                faces = image.ignored_faces
-            elif facetype == 'all':
-                faces = image.faces
-                
-            if image.index == lastimageid:
-                faces = [face for face in faces if face.index > lastfaceid]
-            
-            if (faces):
-                faces = faces[:min(len(faces),numfaces-faceidx)]
-                data.append({
-                    'index': image.index,
-                    'src': f"./image/{image.index}",
-                    'faces': [{'index':face.index, 
-                               'name':face.name,
-                               'ignored':face.ignored,
-                               'src': f"./image/{image.index}/face/{face.index}"} 
-                              for face in faces]
-                    })
-                faceidx += len(faces)
-                if faceidx >= numfaces: break
         return data
     
     def load_duplicates(self,similarity=0.99):
         data = {}
         
         maxdist = int(round(self.library.settings.hash_size**2 * (1-similarity)))
-        duplicates = [(path1,path2,dist) for (path1,path2,dist) in 
-                          self.library.db.execute(f"""SELECT b.filePath, c.filePath, a.dist from similarity a 
-                                            INNER JOIN files b ON b.id = a.id1 
-                                            INNER JOIN files c ON c.id = a.id2
-                                            WHERE a.dist <= {maxdist};""").fetchall()
-                      if os.path.exists(path1) and os.path.exists(path2)]
-        for (path1,path2,dist) in duplicates:
-            img1 = self.library.get_image(path1)
-            img2 = self.library.get_image(path2)
+        pairs = self.library.db.execute("SELECT id1, id2, dist FROM similarity WHERE dist <= ?;",(maxdist,)).fetchall()
+        records = {record.index: record for record in 
+                   self.library.get_records(ids=list({imgindex for (id1,id2,dist) in pairs for imgindex in (id1,id2)}))}
+        
+        def entry(record,dist):
+            return {'index': record.index,
+                    'src': f"./image/{record.index}",
+                    'file_path': record.file_path,
+                    'file_name': record.file_name,
+                    'size': record.size,
+                    'date': record.date,
+                    'dist': dist}
+        
+        for (id1,id2,dist) in pairs:
+            if not id1 in records or not id2 in records:
+                continue
+            (img1,img2) = (records[id1],records[id2])
             if not img1.index in data:
-                data[img1.index] = [{
-                    'index': img1.index,
-                    'src': f"./image/{img1.index}",
-                    'file_path': img1.file_path,
-                    'file_name': img1.file_name,
-                    'size': img1.file_size,
-                    'date': img1.date,
-                    'dist': 0,
-                    }]
-            data[img1.index].append({
-                        'index': img2.index,
-                        'src': f"./image/{img2.index}",
-                        'file_path': img2.file_path,
-                        'file_name': img2.file_name,
-                        'size': img2.file_size,
-                        'date': img2.date,
-                        'dist': dist
-                    })
+                data[img1.index] = [entry(img1,0)]
+            data[img1.index].append(entry(img2,dist))
             if not img2.index in data:
-                data[img2.index] = [{
-                    'index': img2.index,
-                    'src': f"./image/{img2.index}",
-                    'file_path': img2.file_path,
-                    'file_name': img2.file_name,
-                    'size': img2.file_size,
-                    'date': img2.date,
-                    'dist': 0
-                }]
-            data[img2.index].append({
-                        'index': img1.index,
-                        'src': f"./image/{img1.index}",
-                        'file_path': img1.file_path,
-                        'file_name': img1.file_name,
-                        'size': img1.file_size,
-                        'date': img1.date,
-                        'dist': dist
-                    })
+                data[img2.index] = [entry(img2,0)]
+            data[img2.index].append(entry(img1,dist))
             
         # Fuse similar groups
         groups = {}
@@ -387,10 +585,22 @@ class WebGUIServer(threading.Thread):
         return {'order':order,'groups':groups}
 
     def keep_duplicates(self,images):
-        for idx in images:
-            self.library.db.execute(f"DELETE FROM similarity WHERE id1 = {idx} OR id2 = {idx};",True)
+        self.library.db.executemany("DELETE FROM similarity WHERE id1 = ? OR id2 = ?;",[(idx,idx) for idx in images],commit=True)
         return images
 
+    def search(self,query,limit=50,lastimageid=None):
+        ids = self.library.search(query,limit,lastimageid)
+        records = {record.index: record for record in self.library.get_records(ids=ids)}
+        images = [{'index': record.index,
+                   'src': f"./image/{record.index}",
+                   'file_path': record.file_path,
+                   'file_name': record.file_name,
+                   'date': record.date} for record in [records[imgindex] for imgindex in ids if imgindex in records]]
+        # the last id is returned even if its file is missing, so the next page continues behind it
+        return {'query': query,
+                'images': images,
+                'lastimageid': ids[-1] if len(ids) == int(limit) else None}
+    
     def load_logs(self):
         return self.library.log_queue
     
@@ -399,10 +609,11 @@ class WebGUIServer(threading.Thread):
             response = self.library.settings.to_dict()
         elif cmd == 'save_settings':
             self.library.settings.update(data)
+            self.image_cache.resize(int(self.library.settings.thumbnail_cache_size)*1024*1024)
             response = self.library.settings.to_dict()
-        elif cmd in ['load_faces','name_faces','ignore_faces','delete_faces','load_duplicates','load_logs','delete_duplicates','keep_duplicates']:
+        elif cmd in ['load_faces','name_faces','ignore_faces','delete_faces','load_duplicates','load_logs','delete_duplicates','keep_duplicates','search']:
             response = getattr(self,cmd)(**data)
-        elif cmd in ['process']:
+        elif cmd in ['process','embed_sidecars','clean']:
             def process():
                 getattr(self.library,cmd)(**data)
             thread = threading.Thread(target=process, args=())
@@ -425,14 +636,21 @@ class WebGUIServer(threading.Thread):
         else:
             return None
         
+        if cmd in WRITE_COMMANDS:
+            # deferred writes have to be visible to the following reads of all clients
+            self.library.db.flush()
         response = {'cmd': cmd, 'data': response}
-        if not cmd.startswith('load'):
+        if not cmd.startswith('load') and not cmd in QUERY_COMMANDS:
             self.websocket_send_all(response)
         elif not type(ws) == type(None):
             self.websocket_send_single(ws,response)
             
         return response
     
+    async def async_api_call(self,cmd,data,ws=None):
+        executor = self.write_executor if cmd in WRITE_COMMANDS else self.executor
+        return await self.run_blocking(self.api_call,cmd,data,ws,executor=executor,timeout=API_TIMEOUT)
+    
     async def do_GET(self,request):
         # redirects
         if re.match(r'^/(facetagger|annotation|duplicates|settings|logs)?$', request.path) and not self.library.settings.valid_credentials:
@@ -444,25 +662,15 @@ class WebGUIServer(threading.Thread):
             status=200
             content_type='text/html'
             if re.match(r'^/(facetagger|annotation|duplicates|settings|logs|setup)?$', request.path):
-                content = self.html.main.format(content="").encode('utf-8') # content will be set dynamically on the javascript side
+                return self.asset_response(request,self.html['main.html'])
             elif re.match(r'^/web/', request.path):
-                scss_file = os.path.join(PKG_ROOT,'.'+request.path[:-3]+'scss')
-                if (request.path.endswith('.css') and os.path.exists(scss_file)):
-                    content = sass.compile( filename=scss_file ).encode('utf-8')
-                    content_type = 'text/css'
-                else:
-                    (content,content_type) = self.htdocs[request.path]
-                status = 200 if content else 404
+                return self.asset_response(request,self.htdocs[request.path[len('/web/'):]])
             elif re.search(r'^/image/(?P<imageid>\d+)/face/(?P<faceid>\d+)/?$', request.path):
                 data = re.search(r'^/image/(?P<imageid>\d+)/face/(?P<faceid>\d+)/?$', request.path);
-                content = self.get_image_bytes(int(data.group('imageid')),int(data.group('faceid')))
-                content_type = 'image/jpeg'
-                status = 200 if content else 404
+                return await self.image_response(request,int(data.group('imageid')),int(data.group('faceid')))
             elif re.search(r'^/image/(?P<imageid>\d+)/?$', request.path):
                 data = re.search(r'^/image/(?P<imageid>\d+)/?$', request.path);
-                content = self.get_image_bytes(int(data.group('imageid')))
-                content_type = 'image/jpeg'
-                status = 200 if content else 404
+                return await self.image_response(request,int(data.group('imageid')))
             else:
                 content = b''
                 status = 404
@@ -474,6 +682,26 @@ class WebGUIServer(threading.Thread):
             status = 500
         return web.Response(body=content, status=status, content_type=content_type)
 
+    def asset_response(self,request,asset):
+        if not asset:
+            return web.Response(body=b'', status=404, content_type='text/html')
+        
+        accepted = [encoding.split(';')[0].strip() for encoding in request.headers.get('Accept-Encoding','').split(',')
+                    if not re.search(r';\s*q=0(\.0*)?\s*$', encoding)]
+        encoding = next((encoding for encoding in ['br','gzip'] if encoding in accepted and encoding in asset['variants']), None)
+        
+        # strong etags have to differ between encodings
+        etag = '"{}{}"'.format(asset['etag'], '-'+encoding if encoding else '')
+        headers = {'ETag': etag, 'Cache-Control': STATIC_CACHE_CONTROL, 'Vary': 'Accept-Encoding'}
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match and (if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+            return web.Response(status=304, headers=headers)
+        
+        if encoding:
+            headers['Content-Encoding'] = encoding
+            return web.Response(body=asset['variants'][encoding], status=200, content_type=asset['content_type'], headers=headers)
+        return web.Response(body=asset['content'], status=200, content_type=asset['content_type'], headers=headers)
+
     async def do_POST(self,request):
         content_type = 'application/json'
         try:
@@ -484,11 +712,15 @@ class WebGUIServer(threading.Thread):
                     post_data = None
                 status = 200
                 data = re.search(r'^/api/(?P<cmd>[^/]*)/$', request.path)
-                response = self.api_call(data.group('cmd'),post_data)
+                response = await self.async_api_call(data.group('cmd'),post_data)
                 content = json.dumps(response).encode('utf-8')
             else:
                 content = b''
                 status = 404
+        except asyncio.TimeoutError:
+            print(f'Timeout while handling POST request {request.path}')
+            content = json.dumps({"cmd": "error", "data": "timeout"}).encode('utf-8')
+            status = 504
         except Exception as e:
             print(f'Error while handling POST request {request.path}')
             traceback.print_exc() 
@@ -497,25 +729,120 @@ class WebGUIServer(threading.Thread):
             status = 200
         return web.Response(body=content, status=status, content_type=content_type)
 
-    class _fileloader:
-        def __init__(self, path='.', ext='', mode='r', return_mime=False):
-            self.path = path
-            self.ext = ext
-            self.mode = mode
-            self.return_mime = return_mime
-        
-        def openfile(self,file_name):
-            file_path = os.path.abspath(os.path.join(PKG_ROOT, self.path, '.'+os.path.sep+file_name))
-            if os.path.exists(file_path) and os.path.isfile(file_path):
-                with open(file_path,mode=self.mode) as f:
-                    content = f.read()
-                mime_type = mimetypes.guess_type(file_path)[0]
+    class _client:
+        def __init__(self, ws, max_queue=CLIENT_QUEUE_SIZE, send_timeout=CLIENT_SEND_TIMEOUT):
+            self.ws = ws
+            self.max_queue = max_queue
+            self.send_timeout = send_timeout
+            self.queue = collections.deque()
+            self.merged = {} # cmd -> pending entry of merged commands
+            self.pending = asyncio.Event()
+            self.stopped = False
+            self.task = asyncio.ensure_future(self.run())
+            
+        def send(self, cmd, message):
+            # must be called on the server loop, never blocks
+            if self.stopped:
+                return
+            if cmd in MERGED_COMMANDS and cmd in self.merged:
+                self.merged[cmd][1] = message
+                return
+            if len(self.queue) >= self.max_queue:
+                print(f'Disconnecting slow websocket client after {len(self.queue)} pending messages')
+                self.stop()
+                return
+            entry = [cmd, message]
+            if cmd in MERGED_COMMANDS:
+                self.merged[cmd] = entry
+            self.queue.append(entry)
+            self.pending.set()
+            
+        async def run(self):
+            try:
+                while not self.ws.closed:
+                    if not self.queue:
+                        self.pending.clear()
+                        await self.pending.wait()
+                        continue
+                    entry = self.queue.popleft()
+                    if self.merged.get(entry[0]) is entry:
+                        del self.merged[entry[0]]
+                    await asyncio.wait_for(self.ws.send_str(entry[1]), self.send_timeout)
+            except asyncio.TimeoutError:
+                print('Disconnecting websocket client, sending timed out')
+            except (ConnectionResetError, RuntimeError):
+                pass # connection lost
+            except asyncio.CancelledError:
+                pass
+            finally:
+                self.stopped = True
+                self.queue.clear()
+                self.merged.clear()
+                self._close()
+                    
+        def stop(self):
+            # the task might be cancelled before it started, therefore the connection is closed here as well
+            self.stopped = True
+            self.task.cancel()
+            self._close()
+            
+        def _close(self):
+            if not self.ws.closed:
+                asyncio.ensure_future(self.ws.close())
+    
+    class _assets:
+        def __init__(self, path='web', dev=False, transform=None):
+            self.path = os.path.join(PKG_ROOT, path)
+            self.dev = dev
+            self.transform = transform
+            self.lock = threading.Lock()
+            self._assets = {}
+            for name in os.listdir(self.path):
+                if os.path.isfile(os.path.join(self.path, name)) and not name.endswith('.py'):
+                    self._load(name)
+        
+        def source_file(self,name):
+            # stylesheets are compiled from scss files
+            scss_file = os.path.join(self.path, name[:-len('.css')]+'.scss')
+            if name.endswith('.css') and os.path.exists(scss_file):
+                return scss_file
+            return os.path.join(self.path, name)
+        
+        def _load(self,name):
+            source_file = self.source_file(name)
+            if source_file.endswith('.scss'):
+                name = os.path.basename(source_file)[:-len('.scss')]+'.css'
+                content = sass.compile(filename=source_file).encode('utf-8')
+                content_type = 'text/css'
             else:
-                content = mime_type = None
-            return (content,mime_type) if self.return_mime else content
+                with open(source_file,mode='rb') as f:
+                    content = f.read()
+                content_type = mimetypes.guess_type(source_file)[0] or 'application/octet-stream'
+            if self.transform:
+                content = self.transform(name,content)
+            
+            variants = {}
+            if re.match(COMPRESSIBLE_TYPES, content_type):
+                variants['gzip'] = gzip.compress(content, compresslevel=9)
+                try:
+                    import brotli
+                    variants['br'] = brotli.compress(content)
+                except ImportError:
+                    pass
+                variants = {encoding: variant for (encoding, variant) in variants.items() if len(variant) < len(content)}
+                
+            self._assets[name] = {'content': content,
+                                  'content_type': content_type,
+                                  'etag': hashlib.sha1(content).hexdigest()[:20],
+                                  'variants': variants,
+                                  'mtime': os.path.getmtime(source_file)}
         
-        def __getattr__(self,attr):
-            return self.openfile(attr+self.ext)
+        def get(self,name):
+            if self.dev and os.path.isfile(self.source_file(name)):
+                with self.lock:
+                    if not name in self._assets or self._assets[name]['mtime'] != os.path.getmtime(self.source_file(name)):
+                        self._load(name)
+            return self._assets.get(name)
         
         def __getitem__(self,item):
-            return self.openfile(item+self.ext)
+            return self.get(item)
@@ -6,46 +6,178 @@
 # the MIT License: https://opensource.org/licenses/MIT
 #
 import json, os
+import re
+import atexit
+from contextlib import contextmanager
 from typing import Any
 from collections.abc import Callable, Iterable
     
 class sqlitedb:
+    # writes are serialized on a single connection, reads use a read-only connection per thread (WAL mode)
+    READ_STATEMENT = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+    # deferred writes are committed together, once enough writes are pending or the oldest one is too old
+    GROUP_COMMIT_SIZE = 500
+    GROUP_COMMIT_DELAY = 1.0
+    # prepared statements are cached per connection by their sql text, therefore all queries use bound parameters
+    STATEMENT_CACHE_SIZE = 256
+    
     def __init__(self,db_file: str):
         import threading
         import sqlite3
-        self.lock = threading.Lock()
+        self.lock = threading.RLock() # reentrant for writes within a group (see group)
         self.db_file = db_file
-        self.conn = sqlite3.connect(self.db_file,check_same_thread=False)
-        self._load_libs()
+        self.conn = sqlite3.connect(self.db_file,check_same_thread=False,cached_statements=self.STATEMENT_CACHE_SIZE)
+        self._use_readers = self.db_file != ':memory:'
+        if self._use_readers:
+            self.conn.execute("PRAGMA journal_mode=WAL;")
+            self.conn.execute("PRAGMA synchronous=NORMAL;")
+        self._readers = threading.local()
+        self._reader_conns = []
+        self._hexhammdist = self._load_libs(self.conn)
+        self._fts5 = self._check_fts5(self.conn)
+        self._pending = 0
+        self._group_depth = 0
+        self._pending_event = threading.Event()
+        self._committer = None
+        shutdown_handler.add('shutdown',self.flush)
     
-    def _load_libs(self):
+    def _load_libs(self,conn):
         from . import PKG_ROOT
         # EXAMPLE: SELECT photo_id, hexhammdist(photo_hash, ?) AS hd FROM photos WHERE hd <= 9;
         hexhammdist_lib = os.path.join(PKG_ROOT,"sqlite-hexhammdist","sqlite-hexhammdist.so")
-        self._hexhammdist = False
         if os.path.exists(hexhammdist_lib):
             try:
-                self.conn.enable_load_extension(True)
-                self.execute(f"SELECT load_extension('{hexhammdist_lib}', 'hexhammdist_init');", True)
-                self._hexhammdist = True
+                conn.enable_load_extension(True)
+                conn.execute("SELECT load_extension(?, 'hexhammdist_init');",(hexhammdist_lib,))
+                return True
             except:
                 pass
-        
+        return False
+    
+    def _check_fts5(self,conn):
+        # full text search is an optional compile time feature of sqlite
+        try:
+            conn.execute("CREATE VIRTUAL TABLE IF NOT EXISTS temp.fts5_check USING fts5(content);")
+            conn.execute("DROP TABLE temp.fts5_check;")
+            return True
+        except:
+            return False
+    
+    class _reader:
+        # owned by the thread-local of a reading thread, the connection is closed once the thread is gone
+        def __init__(self, conn):
+            self.conn = conn
+    
+    @staticmethod
+    def _close_reader(lock,conns,conn):
+        with lock:
+            if conn in conns:
+                conns.remove(conn)
+                conn.close()
+    
+    @property
+    def reader(self):
+        import sqlite3
+        import weakref
+        from urllib.request import pathname2url
+        if not hasattr(self._readers,'reader'):
+            conn = sqlite3.connect(f'file:{pathname2url(os.path.abspath(self.db_file))}?mode=ro',uri=True,check_same_thread=False,
+                                   cached_statements=self.STATEMENT_CACHE_SIZE)
+            self._load_libs(conn)
+            self._readers.reader = sqlitedb._reader(conn)
+            weakref.finalize(self._readers.reader,sqlitedb._close_reader,self.lock,self._reader_conns,conn)
+            with self.lock:
+                self._reader_conns.append(conn)
+        return self._readers.reader.conn
             
-    def execute(self,sql: str,commit: bool=False):
-        #serialize all commands
+    def execute(self,sql: str,params: Iterable=(),commit: bool=False):
+        # reads do not have to wait for writes
+        if not commit and self._use_readers and self.READ_STATEMENT.match(sql):
+            return self.reader.cursor().execute(sql,params)
+        #serialize all writes
+        with self.lock:
+            result = self.conn.cursor().execute(sql,params)
+            if commit:
+                self._commit()
+        return result
+    
+    def executemany(self,sql: str,seq_of_params: Iterable,commit: bool=False):
         with self.lock:
-            result = self.conn.cursor().execute(sql)
+            result = self.conn.cursor().executemany(sql,seq_of_params)
             if commit:
-                self.conn.commit()
+                self._commit()
         return result
     
+    def execute_deferred(self,sql: str,params: Iterable=(),many: bool=False):
+        # executes the write immediately but commits it with the next group commit,
+        # other connections will only see the change after the commit (see flush)
+        with self.lock:
+            cursor = self.conn.cursor()
+            result = cursor.executemany(sql,params) if many else cursor.execute(sql,params)
+            self._pending += 1
+            if self._pending >= self.GROUP_COMMIT_SIZE and not self._group_depth:
+                self._commit()
+            else:
+                self._start_committer()
+        return result
+    
+    @contextmanager
+    def group(self):
+        # deferred writes of one logical update, group commits only happen before or after all of them,
+        # so readers never see a part of the update (other writers wait until the group is done)
+        with self.lock:
+            self._group_depth += 1
+            try:
+                yield self
+            finally:
+                self._group_depth -= 1
+                if not self._group_depth and self._pending >= self.GROUP_COMMIT_SIZE:
+                    self._commit()
+    
+    def _start_committer(self):
+        import threading
+        self._pending_event.set()
+        if not self._committer:
+            self._committer = threading.Thread(target=self._run_committer,daemon=True)
+            self._committer.start()
+    
+    def _run_committer(self):
+        import time
+        while True:
+            self._pending_event.wait()
+            time.sleep(self.GROUP_COMMIT_DELAY)
+            self.flush()
+    
+    def _commit(self):
+        self.conn.commit()
+        self._pending = 0
+        self._pending_event.clear()
+    
+    def flush(self):
+        # barrier for readers which require to see all previous writes
+        with self.lock:
+            if self._pending:
+                self._commit()
+    
+    def commit(self):
+        with self.lock:
+            self._commit()
+    
     def close(self):
-        self.conn.close()
+        self.flush()
+        shutdown_handler.remove('shutdown',self.flush)
+        with self.lock:
+            [conn.close() for conn in self._reader_conns]
+            self._reader_conns.clear()
+            self.conn.close()
         
     @property
     def hexhammdist(self):
         return self._hexhammdist
+    
+    @property
+    def fts5(self):
+        return self._fts5
         
 class Settings:
     def __init__(self, db:sqlitedb, default: dict={}):
@@ -57,7 +189,7 @@ class Settings:
         self._db.execute("""CREATE TABLE IF NOT EXISTS settings(
             id INTEGER PRIMARY KEY,
             key TEXT NOT NULL UNIQUE,
-            value TEXT NOT NULL);""",True)
+            value TEXT NOT NULL);""",commit=True)
         
     def _get_settings(self,key:str):
         if not key.startswith('_'):
@@ -67,16 +199,13 @@ class Settings:
                 return None
         
     def _set_settings(self,key:str,value:Any):
-        esc_key = key.replace("'", "''")
-        esc_value = json.dumps(value).replace("'", "''")
         if not key in self._settings or self._settings[key] != value:
-            self._db.execute(f"REPLACE INTO settings (key, value) VALUES ('{esc_key}','{esc_value}');",True)
+            self._db.execute("REPLACE INTO settings (key, value) VALUES (?,?);",(key,json.dumps(value)),commit=True)
             self._settings[key] = value
             self.on_settings_changed([key])
         
     def _remove_settings(self,key:str,default:Any=None):
-        esc_key = key.replace("'", "''")
-        self._db.execute(f"DELETE FROM settings WHERE key = '{esc_key}';",True) 
+        self._db.execute("DELETE FROM settings WHERE key = ?;",(key,),commit=True)
         return self._settings.pop(key,default)
         
     def __getattr__(self,key:str):
@@ -92,15 +221,14 @@ class Settings:
             self._set_settings(str(key), value)
 
     def clear(self):
-        esc_keys = ", ".join(["'{}'".format(str(key).replace("'", "''")) for key in self._settings.keys()])
-        self._db.execute(f"DELETE FROM settings WHERE key IN '{esc_keys}';",True) 
+        self._db.executemany("DELETE FROM settings WHERE key = ?;",[(str(key),) for key in self._settings.keys()],commit=True)
         self._settings.clear()
 
     def update(self, iterable:Iterable):
         if (type(iterable) == dict):
             iterable = iterable.items()
-        esc_values = ", ".join(["('{}','{}')".format(str(key).replace("'", "''"),json.dumps(value).replace("'", "''"))  for (key,value) in iterable])
-        self._db.execute(f"REPLACE INTO settings (key, value) VALUES {esc_values};",True)
+        iterable = list(iterable)
+        self._db.executemany("REPLACE INTO settings (key, value) VALUES (?,?);",[(str(key),json.dumps(value)) for (key,value) in iterable],commit=True)
         
         oldsettings = self._settings.copy()
         self._settings.update(iterable)
@@ -162,6 +290,11 @@ class EventHandler(object):
                 
     __call__ = fire
 
+# handlers will be called on a clean shutdown (see goodbye), never from within a signal handler,
+# since the interrupted thread might hold the locks they require
+shutdown_handler = EventHandler()
+atexit.register(shutdown_handler.fire,'shutdown')
+
 def rgb_to_name(requested_colour: str):
     import webcolors
     webcolors.CSS3_HEX_TO_NAMES_SIMPLE = {'#E7E7E7': 'gray white', '#f0f8ff': 'blue', '#faebd7': 'white', '#00ffff': 'turquoise', '#7fffd4': 'turquoise', '#f0ffff': 'azure', '#f5f5dc': 'beige', '#ffe4c4': 'beige', '#000000': 'black', '#ffebcd': 'beige', '#0000ff': 'blue', '#8a2be2': 'purple', '#a52a2a': 'brown', '#deb887': 'brown', '#5f9ea0': 'blue green', '#7fff00': 'green', '#d2691e': 'brown', '#ff7f50': 'orange', '#6495ed': 'blue', '#fff8dc': 'beige', '#dc143c': 'red', '#00008b': 'blue', '#008b8b': 'blue green', '#b8860b': 'brown', '#a9a9a9': 'gray', '#006400': 'green', '#bdb76b': 'khaki', '#8b008b': 'purple', '#556b2f': 'green', '#ff8c00': 'orange', '#9932cc': 'purple', '#8b0000': 'red', '#e9967a': 'red brown', '#8fbc8f': 'green', '#483d8b': 'blue purple', '#2f4f4f': 'green gray', '#00ced1': 'turquoise', '#9400d3': 'purple', '#ff1493': 'pink', '#00bfff': 'blue', '#696969': 'gray', '#1e90ff': 'blue', '#b22222': 'red brown', '#fffaf0': 'white', '#228b22': 'green', '#ff00ff': 'pink', '#dcdcdc': 'gray', '#f8f8ff': 'white', '#ffd700': 'yellow', '#daa520': 'brown', '#808080': 'gray', '#008000': 'green', '#adff2f': 'green', '#f0fff0': 'light green', '#ff69b4': 'pink', '#cd5c5c': 'red brown', '#4b0082': 'blue purple', '#fffff0': 'white', '#f0e68c': 'khaki', '#e6e6fa': 'lavender', '#fff0f5': 'lavender', '#7cfc00': 'green', '#fffacd': 'light yellow', '#add8e6': 'light blue', '#f08080': 'red', '#e0ffff': 'light turquoise', '#fafad2': 'beige', '#d3d3d3': 'gray', '#90ee90': 'light green', '#ffb6c1': 'light pink', '#ffa07a': 'light orange', '#20b2aa': 'turquoise', '#87cefa': 'light blue', '#778899': 'gray', '#b0c4de': 'light blue', '#ffffe0': 'light yellow', '#00ff00': 'green', '#32cd32': 'green', '#800000': 'red brown', '#66cdaa': 'green', '#0000cd': 'blue', '#ba55d3': 'purple', '#9370db': 'purple', '#3cb371': 'green', '#7b68ee': 'blue', '#00fa9a': 'green', '#48d1cc': 'turquoise', '#c71585': 'pink', '#191970': 'blue', '#f5fffa': 'light green', '#ffe4b5': 'beige', '#ffdead': 'beige', '#000080': 'blue', '#fdf5e6': 'beige', '#808000': 'green', '#6b8e23': 'green', '#ffa500': 'orange', '#ff4500': 'orangered', '#da70d6': 'purple', '#eee8aa': 'beige', '#98fb98': 'green', '#afeeee': 'turquoise', '#ffefd5': 'beige', '#ffdab9': 'beige', '#cd853f': 'brown', '#ffc0cb': 'pink', '#dda0dd': 'purple', '#b0e0e6': 'turquoise', '#800080': 'purple', '#ff0000': 'red', '#bc8f8f': 'brown', '#4169e1': 'blue', '#8b4513': 'brown', '#fa8072': 'salmon', '#f4a460': 'brown', '#2e8b57': 'green', '#fff5ee': 'white', '#a0522d': 'brown', '#c0c0c0': 'gray', '#87ceeb': 'blue', '#6a5acd': 'blue', '#708090': 'gray', '#fffafa': 'white', '#00ff7f': 'green', '#4682b4': 'blue', '#d2b48c': 'brown', '#008080': 'green', '#d8bfd8': 'light purple', '#ff6347': 'orange', '#40e0d0': 'turquoise', '#ee82ee': 'pink', '#f5deb3': 'beige', '#ffffff': 'white', '#f5f5f5': 'white', '#ffff00': 'yellow', '#9acd32': 'green' }
@@ -208,4 +341,57 @@ def size_fmt(num):
         if abs(num) < 1000.0:
             return "%3.2f%s" % (num, unit)
         num /= 1024.0
-    return "%.2f%s" % (num, 'YB')
\ No newline at end of file
+    return "%.2f%s" % (num, 'YB')
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int=64*1024*1024):
+        import threading
+        from collections import OrderedDict
+        self.lock = threading.Lock()
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self._items = OrderedDict()
+        
+    def get(self, key, default=None):
+        with self.lock:
+            if not key in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+            
+    def put(self, key, value: Any, size: int=None):
+        size = len(value) if size is None else size
+        with self.lock:
+            self._pop(key)
+            if size > self.max_bytes:
+                return
+            self._items[key] = (value, size)
+            self.num_bytes += size
+            self._evict()
+            
+    def invalidate(self, match: Callable):
+        with self.lock:
+            [self._pop(key) for key in [key for key in self._items if match(key)]]
+            
+    def resize(self, max_bytes: int):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+    
+    def clear(self):
+        with self.lock:
+            self._items.clear()
+            self.num_bytes = 0
+            
+    def _pop(self, key):
+        if key in self._items:
+            self.num_bytes -= self._items.pop(key)[1]
+            
+    def _evict(self):
+        while self.num_bytes > self.max_bytes:
+            (key, (value, size)) = self._items.popitem(last=False)
+            self.num_bytes -= size
+            
+    def __contains__(self, key): return key in self._items
+    def __len__(self): return len(self._items)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021, Sebastian Nagel.
+#
+# This file is part of the module 'gapiannotator' and is released under
+# the MIT License: https://opensource.org/licenses/MIT
+#
+import os
+import json
+import threading
+import weakref
+from array import array
+from collections import deque
+from typing import Iterable
+
+
+class ProcessingProfile:
+    # command and arguments of queued jobs, equal profiles are interned and shared by all their jobs
+    __slots__ = ['cmd','kwargs','__weakref__']
+    _interned = weakref.WeakValueDictionary()
+    _lock = threading.Lock()
+
+    def __init__(self, cmd: str, kwargs: dict):
+        self.cmd = cmd
+        self.kwargs = kwargs
+
+    @classmethod
+    def get(cls, cmd: str, **kwargs):
+        key = (cmd, json.dumps(kwargs, sort_keys=True, default=str))
+        with cls._lock:
+            profile = cls._interned.get(key)
+            if profile is None:
+                profile = cls(cmd, kwargs)
+                cls._interned[key] = profile
+            return profile
+
+class JobQueue:
+    # fifo of (file path, profile) jobs with the interface of queue.Queue used by the processing threads,
+    # consecutive jobs of the same profile share a segment which stores their paths as encoded bytes
+    SEGMENT_SIZE = 10000
+
+    class _Segment:
+        __slots__ = ['profile','data','ends','next']
+
+        def __init__(self, profile: ProcessingProfile):
+            self.profile = profile
+            self.data = bytearray()
+            self.ends = array('Q')
+            self.next = 0
+
+        def __len__(self):
+            return len(self.ends) - self.next
+
+        def append(self, path: str):
+            self.data += os.fsencode(path)
+            self.ends.append(len(self.data))
+
+        def pop(self):
+            start = self.ends[self.next-1] if self.next else 0
+            path = os.fsdecode(bytes(self.data[start:self.ends[self.next]]))
+            self.next += 1
+            return path
+
+    def __init__(self):
+        self.segments = deque()
+        self.size = 0
+        self.unfinished_tasks = 0
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.all_tasks_done = threading.Condition(self.mutex)
+
+    def put(self, path: str, profile: ProcessingProfile):
+        self.put_many([path],profile)
+
+    def put_many(self, paths: Iterable[str], profile: ProcessingProfile):
+        with self.mutex:
+            num_jobs = 0
+            for path in paths:
+                if not self.segments or self.segments[-1].profile is not profile or len(self.segments[-1].ends) >= self.SEGMENT_SIZE:
+                    self.segments.append(self._Segment(profile))
+                self.segments[-1].append(path)
+                num_jobs += 1
+            self.size += num_jobs
+            self.unfinished_tasks += num_jobs
+            self.not_empty.notify(num_jobs)
+
+    def get(self):
+        with self.not_empty:
+            while not self.size:
+                self.not_empty.wait()
+            segment = self.segments[0]
+            path = segment.pop()
+            if not len(segment):
+                self.segments.popleft()
+            self.size -= 1
+            return (path, segment.profile)
+
+    def task_done(self):
+        with self.all_tasks_done:
+            if self.unfinished_tasks <= 0:
+                raise ValueError('task_done() called too many times')
+            self.unfinished_tasks -= 1
+            if not self.unfinished_tasks:
+                self.all_tasks_done.notify_all()
+
+    def join(self):
+        with self.all_tasks_done:
+            while self.unfinished_tasks:
+                self.all_tasks_done.wait()
+
+    def qsize(self):
+        with self.mutex:
+            return self.size
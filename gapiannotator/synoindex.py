@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021, Sebastian Nagel.
+#
+# This file is part of the module 'gapiannotator' and is released under
+# the MIT License: https://opensource.org/licenses/MIT
+#
+import time
+import threading
+import subprocess
+from collections import OrderedDict
+from collections.abc import Callable
+
+from .helper import shutdown_handler
+
+
+class SynoIndexer(threading.Thread):
+    # updates of the synology media index are queued and dispatched by a single thread,
+    # pending updates of the same path are merged (the latest action wins)
+    COMMAND = '/usr/syno/bin/synoindex'
+    DELAY = 1.0 # updates are collected for some time before they are dispatched
+    BATCH_SIZE = 100
+    RATE = 20 # max. commands per second
+
+    def __init__(self, command: str=COMMAND, log: Callable=print, rate: int=RATE):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.command = command
+        self.log = log
+        self.rate = rate
+        self.pending = OrderedDict()
+        self.lock = threading.Lock()
+        self.dispatch_lock = threading.Lock()
+        self.event = threading.Event()
+        shutdown_handler.add('shutdown',self.flush)
+        self.start()
+
+    def add(self, path: str):
+        self._queue(path,'-a')
+
+    def delete(self, path: str):
+        self._queue(path,'-d')
+
+    def _queue(self, path: str, action: str):
+        with self.lock:
+            self.pending.pop(path,None)
+            self.pending[path] = action
+        self.event.set()
+
+    def _next_batch(self):
+        with self.lock:
+            batch = [self.pending.popitem(last=False) for i in range(min(self.BATCH_SIZE,len(self.pending)))]
+            if not self.pending:
+                self.event.clear()
+        return batch
+
+    def _dispatch(self, path: str, action: str):
+        try:
+            output = subprocess.run([self.command, action, path],capture_output=True)
+            if output.returncode != 0:
+                self.log(f'Warning: failed to {"reindex" if action == "-a" else "remove"} file {path} in the synology index')
+        except OSError as e:
+            self.log(f'Warning: failed to run {self.command}: {e}')
+
+    def run(self):
+        while True:
+            self.event.wait()
+            time.sleep(self.DELAY)
+            with self.dispatch_lock:
+                batch = self._next_batch()
+                for (path, action) in batch:
+                    started = time.monotonic()
+                    self._dispatch(path,action)
+                    time.sleep(max(0, 1/self.rate - (time.monotonic()-started)))
+
+    def flush(self):
+        # dispatches all pending updates without rate limit (e.g. on shutdown)
+        with self.dispatch_lock:
+            batch = self._next_batch()
+            while batch:
+                [self._dispatch(path,action) for (path, action) in batch]
+                batch = self._next_batch()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021, Sebastian Nagel.
+#
+# This file is part of the module 'gapiannotator' and is released under
+# the MIT License: https://opensource.org/licenses/MIT
+#
+import os
+import mmap
+import shutil
+import threading
+
+from .helper import sqlitedb
+
+
+class FolderThumbnailStore:
+    # thumbnails are stored as single files in a folder next to each image,
+    # on synology the '@eaDir' layout of the photo station is used
+    def __init__(self, folder: str='.thumbs'):
+        self.folder = folder
+
+    def thumb_path(self, file_path: str):
+        return os.path.join(os.path.dirname(file_path),self.folder,os.path.basename(file_path))
+
+    def file(self, image, name: str):
+        return os.path.abspath(os.path.join(self.thumb_path(image.file_path),name))
+
+    def exists(self, image, name: str):
+        return os.path.exists(self.file(image,name))
+
+    def read(self, image, name: str):
+        try:
+            with open(self.file(image,name),'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def write(self, image, name: str, data: bytes):
+        os.makedirs(self.thumb_path(image.file_path), exist_ok=True)
+        with open(self.file(image,name),'wb') as f:
+            f.write(data)
+
+    def write_many(self, image, thumbnails: dict):
+        [self.write(image,name,data) for (name, data) in thumbnails.items()]
+
+    def remove(self, image, name: str):
+        if self.exists(image,name):
+            os.remove(self.file(image,name))
+
+    def remove_all(self, index: int, file_path: str):
+        shutil.rmtree(self.thumb_path(file_path), ignore_errors=True)
+
+    def move(self, index: int, from_path: str, to_path: str):
+        # thumbnails of moved folders are moved along with the folder itself
+        if os.path.isdir(self.thumb_path(from_path)) and not os.path.exists(self.thumb_path(to_path)):
+            os.makedirs(os.path.dirname(self.thumb_path(to_path)), exist_ok=True)
+            shutil.move(self.thumb_path(from_path),self.thumb_path(to_path))
+
+    def compact(self):
+        return 0
+
+    def close(self):
+        pass
+
+class PackedThumbnailStore:
+    # thumbnails are appended to a few large pack files, the offset/length index is kept in sqlite
+    PACK_SIZE = 512*1024*1024
+    MIN_LIVE_RATIO = 0.5
+
+    def __init__(self, db: sqlitedb, path: str):
+        self.db = db
+        self.path = os.path.abspath(path)
+        self.lock = threading.RLock()
+        self._maps = {}
+        self._writer = None
+        os.makedirs(self.path, exist_ok=True)
+        self.checkTable()
+        (pack,) = self.db.execute("SELECT MAX(pack) FROM thumbnails;").fetchone()
+        self._pack = pack or 0
+
+    def checkTable(self):
+        self.db.execute("""CREATE TABLE IF NOT EXISTS thumbnails(
+            imageId INTEGER NOT NULL,
+            name TEXT NOT NULL,
+            pack INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            length INTEGER NOT NULL,
+            PRIMARY KEY(imageId,name));""",commit=True)
+        self.db.execute("CREATE INDEX IF NOT EXISTS thumbnails_pack ON thumbnails(pack);",commit=True)
+
+    def pack_file(self, pack: int):
+        return os.path.join(self.path,f'pack_{pack:05d}.bin')
+
+    def _lookup(self, index: int, name: str):
+        return self.db.execute("SELECT pack, offset, length FROM thumbnails WHERE imageId = ? AND name = ?;",(index,name)).fetchone()
+
+    def _map(self, pack: int, end: int):
+        # (re)map the pack file if it has grown since it was mapped last
+        if pack not in self._maps or len(self._maps[pack]) < end:
+            self._unmap(pack)
+            if pack == self._pack and self._writer:
+                self._writer.flush()
+            with open(self.pack_file(pack),'rb') as f:
+                self._maps[pack] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._maps[pack]
+
+    def _unmap(self, pack: int):
+        if pack in self._maps:
+            self._maps.pop(pack).close()
+
+    def _append(self, data: bytes):
+        if not self._writer or (self._writer.tell() + len(data) > self.PACK_SIZE and self._writer.tell() > 0):
+            self._rotate(self._pack if not self._writer else self._pack+1)
+        offset = self._writer.tell()
+        self._writer.write(data)
+        return (self._pack, offset)
+
+    def _rotate(self, pack: int):
+        if self._writer:
+            self._writer.close()
+        self._pack = pack
+        self._writer = open(self.pack_file(pack),'ab')
+
+    def file(self, image, name: str):
+        return None
+
+    def exists(self, image, name: str):
+        return self._lookup(image.index,name) is not None
+
+    def read(self, image, name: str):
+        with self.lock:
+            entry = self._lookup(image.index,name)
+            if not entry:
+                return None
+            (pack, offset, length) = entry
+            return self._map(pack,offset+length)[offset:offset+length]
+
+    def write(self, image, name: str, data: bytes):
+        with self.lock:
+            (pack, offset) = self._append(data)
+            self._writer.flush()
+            self.db.execute("REPLACE INTO thumbnails (imageId, name, pack, offset, length) VALUES (?,?,?,?,?);",(image.index,name,pack,offset,len(data)),commit=True)
+
+    def write_many(self, image, thumbnails: dict):
+        # all thumbnails of an image are indexed with a single commit
+        with self.lock:
+            entries = []
+            for (name, data) in thumbnails.items():
+                (pack, offset) = self._append(data)
+                entries.append((image.index,name,pack,offset,len(data)))
+            self._writer.flush()
+            self.db.executemany("REPLACE INTO thumbnails (imageId, name, pack, offset, length) VALUES (?,?,?,?,?);",entries,commit=True)
+
+    def remove(self, image, name: str):
+        self.db.execute("DELETE FROM thumbnails WHERE imageId = ? AND name = ?;",(image.index,name),commit=True)
+
+    def remove_all(self, index: int, file_path: str):
+        self.db.execute("DELETE FROM thumbnails WHERE imageId = ?;",(index,),commit=True)
+
+    def move(self, index: int, from_path: str, to_path: str):
+        pass
+
+    def compact(self, min_live_ratio: float=MIN_LIVE_RATIO):
+        # rewrite packs which mostly contain dead entries, returns the number of freed bytes
+        freed = 0
+        with self.lock:
+            packs = sorted([int(name[5:10]) for name in os.listdir(self.path) if name.startswith('pack_') and name.endswith('.bin')])
+            live = dict(self.db.execute("SELECT pack, SUM(length) FROM thumbnails GROUP BY pack;").fetchall())
+            for pack in packs:
+                size = os.path.getsize(self.pack_file(pack))
+                if size == 0 or live.get(pack,0)/size >= min_live_ratio:
+                    continue
+                if pack == self._pack:
+                    self._rotate(max(packs)+1)
+                entries = self.db.execute("SELECT imageId, name, offset, length FROM thumbnails WHERE pack = ?;",(pack,)).fetchall()
+                for (index, name, offset, length) in entries:
+                    (new_pack, new_offset) = self._append(self._map(pack,offset+length)[offset:offset+length])
+                    self.db.execute("UPDATE thumbnails SET pack = ?, offset = ? WHERE imageId = ? AND name = ?;",(new_pack,new_offset,index,name))
+                self._writer.flush()
+                self.db.commit() # the updated offsets have to be stored before the old pack is removed
+                self._unmap(pack)
+                os.remove(self.pack_file(pack))
+                freed += size - live.get(pack,0)
+        return freed
+
+    def close(self):
+        with self.lock:
+            [self._unmap(pack) for pack in list(self._maps)]
+            if self._writer:
+                self._writer.close()
+                self._writer = None
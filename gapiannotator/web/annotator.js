@@ -537,11 +537,15 @@ class RemoteClient {
             RemoteClient.ws.onmessage = function(evt){
                 try {
                     let data = JSON.parse(evt.data);
-                    if (data.cmd in RemoteClient._callbacks) {
-                        RemoteClient._callbacks[data.cmd].forEach(function(fun){
-                            fun(data.data);
-                        });
-                    }
+                    // frequent messages (progress, logs) are sent together as batch
+                    let messages = (data.cmd == 'batch') ? data.data : [data];
+                    messages.forEach(function(data){
+                        if (data.cmd in RemoteClient._callbacks) {
+                            RemoteClient._callbacks[data.cmd].forEach(function(fun){
+                                fun(data.data);
+                            });
+                        }
+                    });
                 }
                 catch(err) {
                     console.error('Failed to handle websocket event: ' + err.message);
@@ -779,6 +783,18 @@ class Page {
         RemoteClient.add_callback('new_faces', data => new Popup('','New faces found.'));
         RemoteClient.add_callback('name_faces ignore_faces delete_faces', data => new Popup('','Faces updated.'));
         RemoteClient.add_callback('process', data => new Popup('Scanning paths...','Annotation will start afterwards.'));
+        RemoteClient.add_callback('job_progress',function(data) {
+            if (data.done < data.total)
+                page.progress.html('Writing metadata: '+data.done+' of '+data.total+' images');
+            else
+                page.progress.html('Metadata written'+((data.failed > 0)?' ('+data.failed+' failed)':''));
+        });
+        RemoteClient.add_callback('clean_progress',function(data) {
+            if (data.done < data.total)
+                page.progress.html('Cleaning library: '+data.done+' of '+data.total+' folders');
+            else
+                page.progress.html('Library cleaned, '+data.removed+' file(s) removed');
+        });
     }
 
     static Annotation = class extends Page {
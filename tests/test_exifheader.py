@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021, Sebastian Nagel.
+#
+# This file is part of the module 'gapiannotator' and is released under
+# the MIT License: https://opensource.org/licenses/MIT
+#
+import struct
+
+from gapiannotator.exifheader import read_header, EMPTY_HEADER
+
+
+def build_jpeg(path, ifd0, exif=None, gps=None):
+    # little-endian tiff with all values stored inline or behind the ifds, entries are (tag, type, count, bytes)
+    def ifd(entries, offset, sub_offsets={}):
+        entries = entries + [(tag, 4, 1, struct.pack('<I', sub_offset)) for (tag, sub_offset) in sub_offsets.items()]
+        data_offset = offset + 2 + 12*len(entries) + 4
+        (table, data) = (struct.pack('<H', len(entries)), b'')
+        for (tag, type, count, value) in sorted(entries):
+            if len(value) <= 4:
+                table += struct.pack('<HHI', tag, type, count) + value.ljust(4, b'\x00')
+            else:
+                table += struct.pack('<HHII', tag, type, count, data_offset + len(data))
+                data += value
+        return table + struct.pack('<I', 0) + data
+    (exif_offset, gps_offset) = (200, 400)
+    sub_offsets = {}
+    if exif is not None:
+        sub_offsets[0x8769] = exif_offset
+    if gps is not None:
+        sub_offsets[0x8825] = gps_offset
+    tiff = bytearray(b'II*\x00' + struct.pack('<I', 8) + ifd(ifd0, 8, sub_offsets))
+    for (entries, offset) in [(exif, exif_offset), (gps, gps_offset)]:
+        if entries is not None:
+            tiff = tiff.ljust(offset, b'\x00') + ifd(entries, offset)
+    app1 = b'Exif\x00\x00' + bytes(tiff)
+    sof = b'\x08' + struct.pack('>HH', 480, 640) + b'\x01\x01\x11\x00'
+    with open(path, 'wb') as f:
+        f.write(b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(app1)+2) + app1
+                + b'\xff\xc0' + struct.pack('>H', len(sof)+2) + sof + b'\xff\xda\x00\x02\xff\xd9')
+
+def rational(*values):
+    return b''.join([struct.pack('<II', int(value*100), 100) for value in values])
+
+def test_read_header(tmp_path):
+    path = str(tmp_path / 'image.jpg')
+    build_jpeg(path,
+               [(0x0112, 3, 1, struct.pack('<H', 6))],
+               exif=[(0x9003, 2, 20, b'2021:05:01 12:30:00\x00')],
+               gps=[(1, 2, 2, b'N\x00'), (2, 5, 3, rational(52, 31, 12)),
+                    (3, 2, 2, b'W\x00'), (4, 5, 3, rational(13, 24, 0))])
+    header = read_header(path)
+    assert header['orientation'] == 6
+    assert header['date'] is not None
+    assert header['latlon'] == (52.52, -13.4)
+    assert (header['width'], header['height']) == (640, 480)
+
+def test_read_header_with_malformed_types(tmp_path):
+    # date, orientation and gps refs stored with numeric/ascii types instead of the expected ones
+    path = str(tmp_path / 'image.jpg')
+    build_jpeg(path,
+               [(0x0112, 2, 2, b'6\x00')],
+               exif=[(0x9003, 3, 2, struct.pack('<HH', 2021, 5))],
+               gps=[(1, 3, 1, struct.pack('<H', 1)), (2, 5, 3, rational(52, 31, 12)),
+                    (3, 2, 2, b'W\x00'), (4, 2, 4, b'13\x00\x00')])
+    header = read_header(path)
+    assert header['orientation'] == EMPTY_HEADER['orientation']
+    assert header['date'] is None
+    assert header['latlon'] is None
+    assert (header['width'], header['height']) == (640, 480)
+
+def test_read_header_with_unknown_byte_order(tmp_path):
+    path = tmp_path / 'image.jpg'
+    for tiff in [b'', b'XX*\x00\x08\x00\x00\x00']:
+        app1 = b'Exif\x00\x00' + tiff
+        path.write_bytes(b'\xff\xd8' + b'\xff\xe1' + struct.pack('>H', len(app1)+2) + app1 + b'\xff\xda\x00\x02\xff\xd9')
+        assert read_header(str(path)) == EMPTY_HEADER
+
+def test_read_header_with_truncated_frame_header(tmp_path):
+    path = tmp_path / 'image.jpg'
+    path.write_bytes(b'\xff\xd8' + b'\xff\xc0\x00\x11\x08\x01')
+    assert read_header(str(path)) == EMPTY_HEADER
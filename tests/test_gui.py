@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021, Sebastian Nagel.
+#
+# This file is part of the module 'gapiannotator' and is released under
+# the MIT License: https://opensource.org/licenses/MIT
+#
+import time
+import threading
+import json
+import asyncio
+
+from aiohttp.test_utils import TestServer, TestClient
+
+from gapiannotator.gui import WebGUIServer
+from gapiannotator.helper import sqlitedb, Settings, EventHandler
+
+
+class Library:
+    # the parts of ImageLibrary the server needs to start
+    def __init__(self):
+        self.db = sqlitedb(':memory:')
+        self.settings = Settings(self.db, {'thumbnail_cache_size': 1, 'valid_credentials': True})
+        self.event = EventHandler()
+        self.log_queue = []
+
+    def log(self, message):
+        self.log_queue.append(message)
+
+async def start_client(server):
+    server.loop = asyncio.get_running_loop()
+    client = TestClient(TestServer(server.create_runner().app))
+    await client.start_server()
+    return client
+
+def test_websocket_calls_are_answered_in_order():
+    server = WebGUIServer(Library())
+    def name_faces(images, name):
+        time.sleep(0.3)
+        return 'named'
+    server.name_faces = name_faces
+    server.load_faces = lambda: 'loaded'
+
+    async def run():
+        client = await start_client(server)
+        try:
+            ws = await client.ws_connect('/ws')
+            await ws.send_str(json.dumps({'cmd': 'name_faces', 'data': {'images': {}, 'name': 'x'}}))
+            await ws.send_str(json.dumps({'cmd': 'load_faces', 'data': {}}))
+            responses = [json.loads((await ws.receive(timeout=5)).data) for i in range(2)]
+            await ws.close()
+        finally:
+            await client.close()
+        return responses
+
+    responses = asyncio.run(run())
+    assert [(response['cmd'], response['data']) for response in responses] == [('name_faces', 'named'), ('load_faces', 'loaded')]
+
+def test_thumbnail_latency_during_heavy_call():
+    server = WebGUIServer(Library())
+    def load_faces():
+        time.sleep(2)
+        return []
+    server.load_faces = load_faces
+    server.get_thumbnail_file = lambda imageid, faceid=None: None
+    server.get_cached_image = lambda imageid, faceid=None: (b'jpeg', '"etag"')
+
+    async def latency(client):
+        started = time.monotonic()
+        response = await client.get('/image/1')
+        assert response.status == 200
+        await response.read()
+        return time.monotonic() - started
+
+    async def run():
+        client = await start_client(server)
+        try:
+            idle = max([await latency(client) for i in range(5)])
+            ws = await client.ws_connect('/ws')
+            await ws.send_str(json.dumps({'cmd': 'load_faces', 'data': {}}))
+            await asyncio.sleep(0.1)
+            busy = max([await latency(client) for i in range(20)])
+            response = json.loads((await ws.receive(timeout=5)).data)
+            await ws.close()
+        finally:
+            await client.close()
+        return (idle, busy, response)
+
+    (idle, busy, response) = asyncio.run(run())
+    assert response['cmd'] == 'load_faces'
+    assert busy < idle + 0.5
+
+class WebSocket:
+    # records the sent messages, a throttled socket takes far longer for each message
+    def __init__(self, delay=0):
+        self.delay = delay
+        self.closed = False
+        self.messages = []
+
+    async def send_str(self, message):
+        await asyncio.sleep(self.delay)
+        self.messages.append(message)
+
+    async def close(self):
+        self.closed = True
+
+def test_slow_client_does_not_delay_others():
+    async def run():
+        sockets = [WebSocket() for i in range(49)] + [WebSocket(delay=10)]
+        clients = [WebGUIServer._client(ws, max_queue=100) for ws in sockets]
+        started = time.monotonic()
+        for i in range(500):
+            [client.send('deleted_image', json.dumps({'cmd': 'deleted_image', 'data': i})) for client in clients]
+            await asyncio.sleep(0.001)
+        while any([len(ws.messages) < 500 for ws in sockets[:-1]]):
+            await asyncio.sleep(0.01)
+            assert time.monotonic() - started < 5
+        await asyncio.sleep(0)
+        [client.stop() for client in clients]
+        await asyncio.sleep(0)
+        return (sockets, clients)
+
+    (sockets, clients) = asyncio.run(run())
+    for ws in sockets[:-1]:
+        assert [json.loads(message)['data'] for message in ws.messages] == list(range(500))
+    # the throttled client exceeded its queue and was disconnected
+    assert clients[-1].stopped and sockets[-1].closed
+    assert sockets[-1].messages == []
+
+def test_merged_commands_keep_only_the_latest_message():
+    async def run():
+        ws = WebSocket(delay=0.05)
+        client = WebGUIServer._client(ws)
+        for i in range(100):
+            client.send('remaining_files', json.dumps({'cmd': 'remaining_files', 'data': i}))
+        await asyncio.sleep(0.3)
+        client.stop()
+        await asyncio.sleep(0)
+        return ws
+
+    ws = asyncio.run(run())
+    assert [json.loads(message)['data'] for message in ws.messages] == [99]
+
+def test_face_jobs_of_an_image_run_in_order():
+    server = WebGUIServer(Library())
+    (runs, done) = ([], threading.Event())
+    def run_face_job(job, imgindex, faces, name=None):
+        time.sleep(0.05 if job['cmd'] == 'delete_faces' else 0)
+        runs.append((imgindex, job['cmd']))
+        if len(runs) == 6:
+            done.set()
+    server.run_face_job = run_face_job
+    for cmd in ['delete_faces', 'name_faces', 'ignore_faces']:
+        server.submit_face_job(cmd, {1: [1], 2: [1]}, 'x')
+    assert done.wait(5)
+    for imgindex in [1, 2]:
+        assert [cmd for (index, cmd) in runs if index == imgindex] == ['delete_faces', 'name_faces', 'ignore_faces']
+    deadline = time.monotonic() + 1
+    while server._face_chains and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert server._face_chains == {}
+
+def test_face_thumbnails_wait_for_the_face_jobs():
+    server = WebGUIServer(Library())
+    server.run_face_job = lambda job, imgindex, faces, name=None: time.sleep(0.3)
+
+    async def run():
+        server.loop = asyncio.get_running_loop()
+        server.submit_face_job('delete_faces', {1: [1]}, None)
+        started = time.monotonic()
+        await server.wait_for_face_jobs(1, timeout=5)
+        waited = time.monotonic() - started
+        await server.wait_for_face_jobs(2, timeout=5)
+        return waited
+
+    waited = asyncio.run(run())
+    assert 0.2 < waited < 1
+    assert server._face_chains == {} and server._face_chain_events == {}
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021, Sebastian Nagel.
+#
+# This file is part of the module 'gapiannotator' and is released under
+# the MIT License: https://opensource.org/licenses/MIT
+#
+import sqlite3
+
+from gapiannotator.helper import sqlitedb
+
+
+def count(db_file):
+    return sqlite3.connect(db_file).execute("SELECT COUNT(*) FROM faces;").fetchone()[0]
+
+def test_group_is_committed_as_a_whole(tmp_path):
+    db_file = str(tmp_path / 'test.db')
+    db = sqlitedb(db_file)
+    db.GROUP_COMMIT_SIZE = 2
+    db.execute("CREATE TABLE faces(imageId INTEGER, faceIndex INTEGER);", commit=True)
+    with db.group():
+        for faceindex in range(1, 4):
+            db.execute_deferred("INSERT INTO faces VALUES (?,?);", (1, faceindex))
+        assert count(db_file) == 0
+    assert count(db_file) == 3
+    db.close()
+
+def test_deferred_writes_are_visible_after_flush(tmp_path):
+    db_file = str(tmp_path / 'test.db')
+    db = sqlitedb(db_file)
+    db.execute("CREATE TABLE faces(imageId INTEGER, faceIndex INTEGER);", commit=True)
+    db.execute_deferred("INSERT INTO faces VALUES (?,?);", (1, 1))
+    assert db.execute("SELECT COUNT(*) FROM faces;").fetchone()[0] == 0
+    db.flush()
+    assert db.execute("SELECT COUNT(*) FROM faces;").fetchone()[0] == 1
+    db.close()
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021, Sebastian Nagel.
+#
+# This file is part of the module 'gapiannotator' and is released under
+# the MIT License: https://opensource.org/licenses/MIT
+#
+import os
+import time
+
+from gapiannotator.synoindex import SynoIndexer
+
+
+def stub_command(tmp_path, returncode=0):
+    # stands in for synoindex, every call is appended to calls.log
+    log_file = tmp_path / 'calls.log'
+    command = tmp_path / 'synoindex'
+    command.write_text(f'#!/bin/sh\necho "$1 $2" >> "{log_file}"\nexit {returncode}\n')
+    os.chmod(command, 0o755)
+    return (str(command), log_file)
+
+def calls(log_file):
+    return log_file.read_text().splitlines() if log_file.exists() else []
+
+def test_pending_updates_are_merged(tmp_path):
+    (command, log_file) = stub_command(tmp_path)
+    indexer = SynoIndexer(command)
+    for i in range(50):
+        indexer.add(f'/photo/{i % 10}.jpg')
+    indexer.delete('/photo/3.jpg')
+    indexer.flush()
+    assert len(calls(log_file)) == 10
+    assert calls(log_file)[-1] == '-d /photo/3.jpg'
+    assert calls(log_file).count('-a /photo/3.jpg') == 0
+
+def test_updates_are_dispatched_by_the_thread(tmp_path):
+    (command, log_file) = stub_command(tmp_path)
+    indexer = SynoIndexer(command, rate=100)
+    indexer.DELAY = 0.1
+    [indexer.add(f'/photo/{i}.jpg') for i in range(5)]
+    deadline = time.monotonic() + 5
+    while len(calls(log_file)) < 5 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert calls(log_file) == [f'-a /photo/{i}.jpg' for i in range(5)]
+
+def test_failures_are_logged(tmp_path):
+    (command, log_file) = stub_command(tmp_path, returncode=1)
+    messages = []
+    indexer = SynoIndexer(command, log=messages.append)
+    indexer.add('/photo/1.jpg')
+    indexer.flush()
+    assert calls(log_file) == ['-a /photo/1.jpg']
+    assert messages and messages[0].startswith('Warning')
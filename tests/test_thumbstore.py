@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2021, Sebastian Nagel.
+#
+# This file is part of the module 'gapiannotator' and is released under
+# the MIT License: https://opensource.org/licenses/MIT
+#
+from types import SimpleNamespace
+
+from gapiannotator.helper import sqlitedb
+from gapiannotator.thumbstore import FolderThumbnailStore, PackedThumbnailStore
+
+
+def test_packed_store_writes_all_thumbnails_of_an_image(tmp_path):
+    db = sqlitedb(':memory:')
+    store = PackedThumbnailStore(db, str(tmp_path / 'thumbnails'))
+    image = SimpleNamespace(index=1, file_path=str(tmp_path / 'image.jpg'))
+    thumbnails = {f'thumb_{size}.jpg': bytes([size])*size for size in range(1, 7)}
+    store.write_many(image, thumbnails)
+    assert {name: store.read(image, name) for name in thumbnails} == thumbnails
+    store.remove_all(image.index, image.file_path)
+    assert not store.exists(image, 'thumb_1.jpg')
+    store.close()
+
+def test_folder_store_writes_all_thumbnails_of_an_image(tmp_path):
+    store = FolderThumbnailStore()
+    image = SimpleNamespace(index=1, file_path=str(tmp_path / 'image.jpg'))
+    thumbnails = {'S.jpg': b'small', 'L.jpg': b'large'}
+    store.write_many(image, thumbnails)
+    assert {name: store.read(image, name) for name in thumbnails} == thumbnails